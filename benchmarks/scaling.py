@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+"""
+Measures how discovery and capability sync of ZOCP scale with the
+number of nodes starting together.
+
+For each node count, the nodes are spread over worker processes, each
+polling its nodes round robin. Every node has a synthetic capability
+of a number of objects. Reported are the seconds until every node saw
+all others enter and until every node has the capability of all
+others, the bytes of the ZOCP messages sent and received as counted
+by the metrics of the nodes, and the peak RSS of the workers. Results
+are written as JSON.
+
+Nodes talk over loopback TCP through StaticTransport, seeded by the
+first node, unless another transport is chosen. Every node connects
+to every other node, so large counts need more workers and a higher
+limit of open files. The memory transport runs in a single worker.
+"""
+
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+import zmq
+from zocp import ZOCP, StaticTransport, MemoryNetwork
+
+
+def create_node(transport, index, seed, network, objects):
+    if transport == 'memory':
+        node = ZOCP(transport=network.transport())
+    elif transport == 'static':
+        if index == 0:
+            node = ZOCP(transport=StaticTransport(seed))
+        else:
+            node = ZOCP(transport=StaticTransport("tcp://127.0.0.1:*", [seed]))
+    else:
+        node = ZOCP()
+    node.set_name("scale%d" % index)
+    for i in range(objects):
+        node.set_object("obj%d" % i, "Synthetic")
+        node.register_vec3f("location", [0.0, 0.0, 0.0], 'rwe')
+        node.register_float("value", float(i), 'rwe')
+    node.set_object()
+    return node
+
+
+def is_synced(node, objects):
+    for capability in node.peers_capabilities.values():
+        if len(capability.get("objects", {})) < objects:
+            return False
+    return True
+
+
+def worker(indexes, count, options, ready, go, stop, results):
+    """
+    Run the nodes of indexes until stop is set, putting the times every
+    node saw all peers enter and got all their capabilities in results
+    """
+    zmq.Context.instance().set(zmq.MAX_SOCKETS, 65536)
+    network = MemoryNetwork() if options['transport'] == 'memory' else None
+    nodes = [create_node(options['transport'], index, options['seed'], network,
+                         options['objects']) for index in indexes]
+    ready.put(len(nodes))
+    entered = {}
+    synced = {}
+    go.wait()
+    for node in nodes:
+        node.start()
+    check = 0.0
+    while not stop.is_set():
+        for node in nodes:
+            node.run_once(0)
+        now = time.time()
+        if now - check < options['interval'] or len(synced) == len(nodes):
+            continue
+        check = now
+        for node in nodes:
+            if node in synced:
+                continue
+            if node not in entered and len(node.peers_capabilities) >= count - 1:
+                entered[node] = now
+            if node in entered and is_synced(node, options['objects']):
+                synced[node] = now
+                if len(synced) == len(nodes):
+                    totals = [n.get_metrics()['totals'] for n in nodes]
+                    results.put({
+                        'entered': max(entered.values()),
+                        'synced': max(synced.values()),
+                        'bytes_sent': sum(t['bytes_out'] for t in totals),
+                        'bytes_received': sum(t['bytes_in'] for t in totals),
+                        'messages': sum(t['messages_in'] for t in totals),
+                        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                    })
+    for node in nodes:
+        node.stop()
+    if network is not None:
+        network.close()
+
+
+def run(count, options):
+    workers = 1 if options['transport'] == 'memory' else min(options['processes'], count)
+    ready = multiprocessing.Queue()
+    go = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = []
+    for i in range(workers):
+        process = multiprocessing.Process(target=worker, args=(
+            list(range(i, count, workers)), count, options, ready, go, stop, results))
+        process.start()
+        processes.append(process)
+    # start the nodes together once all workers created theirs
+    for process in processes:
+        ready.get()
+    start = time.time()
+    go.set()
+    reports = []
+    try:
+        for i in range(workers):
+            reports.append(results.get(timeout=max(0, start + options['timeout'] - time.time())))
+    except Empty:
+        pass
+    finally:
+        stop.set()
+        for process in processes:
+            process.join()
+    result = {'nodes': count, 'processes': workers, 'completed': len(reports) == workers}
+    if reports:
+        result.update({
+            'enter_s': max(r['entered'] for r in reports) - start,
+            'synced_s': max(r['synced'] for r in reports) - start,
+            'bytes_sent': sum(r['bytes_sent'] for r in reports),
+            'bytes_received': sum(r['bytes_received'] for r in reports),
+            'messages': sum(r['messages'] for r in reports),
+            'peak_rss_kb': max(r['peak_rss_kb'] for r in reports),
+            'total_rss_kb': sum(r['peak_rss_kb'] for r in reports),
+        })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--transport', choices=('static', 'pyre', 'memory'), default='static',
+                        help="transport between the nodes")
+    parser.add_argument('--nodes', type=int, nargs='+', default=[10, 25, 50, 100],
+                        help="node counts to measure")
+    parser.add_argument('--processes', type=int, default=4,
+                        help="worker processes to spread the nodes over")
+    parser.add_argument('--objects', type=int, default=10,
+                        help="objects in the capability of every node")
+    parser.add_argument('--port', type=int, default=5670,
+                        help="port of the seed node of StaticTransport")
+    parser.add_argument('--interval', type=float, default=0.05,
+                        help="seconds between checking the progress of the nodes")
+    parser.add_argument('--timeout', type=float, default=120.0,
+                        help="seconds to wait for the nodes to sync")
+    parser.add_argument('--output', help="file to write the JSON results to, default stdout")
+    args = parser.parse_args()
+
+    options = {
+        'transport': args.transport,
+        'processes': args.processes,
+        'objects': args.objects,
+        'seed': "tcp://127.0.0.1:%d" % args.port,
+        'interval': args.interval,
+        'timeout': args.timeout,
+    }
+    results = {
+        'benchmark': 'scaling',
+        'transport': args.transport,
+        'objects': args.objects,
+        'python': platform.python_version(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'runs': [],
+    }
+    for count in args.nodes:
+        result = run(count, options)
+        if result['completed']:
+            sys.stderr.write("%d nodes: entered %.2f s synced %.2f s %d bytes sent "
+                             "peak rss %d kB\n" % (count, result['enter_s'], result['synced_s'],
+                                                   result['bytes_sent'], result['peak_rss_kb']))
+        else:
+            sys.stderr.write("%d nodes: not synced within %.0f s\n" % (count, args.timeout))
+        results['runs'].append(result)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
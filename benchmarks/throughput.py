@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+"""
+Measures the signal throughput and latency of ZOCP nodes, and the cost
+of getting and modifying capabilities versus their size.
+
+Signals are emitted by one node to a number of subscribed peers, each
+subscribing a number of receivers (the fan-out) to the emitter. Every
+node runs in this process and is polled round robin from one thread,
+talking over loopback TCP using StaticTransport unless another
+transport is chosen, with local delivery turned off so the signals
+take the transport. Results are written as JSON, for comparing runs.
+"""
+
+import argparse
+import collections
+import json
+import platform
+import sys
+import time
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from zocp import ZOCP, StaticTransport, MemoryNetwork
+
+# payload type hint : method registering a parameter of the type
+PAYLOADS = collections.OrderedDict([
+    ('flt', 'register_float'),
+    ('vec3f', 'register_vec3f'),
+    ('string', 'register_string'),
+])
+
+
+class Receiver(ZOCP):
+    """
+    Node recording the latency of the signals it receives, the values
+    carry the time they were emitted
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Receiver, self).__init__(*args, **kwargs)
+        self.latencies = []
+        self.last_received = 0.0
+
+    def on_peer_signaled(self, peer, name, data, *args, **kwargs):
+        self.last_received = time.time()
+        self.latencies.append(self.last_received - sent_time(data[1]))
+
+
+def payload(type_hint, size):
+    """
+    Return a value of type_hint holding the current time
+    """
+    now = time.time()
+    if type_hint == 'flt':
+        return now
+    if type_hint == 'vec3f':
+        return [now, 0.0, 0.0]
+    return ("%.6f " % now).ljust(size, "x")
+
+
+def sent_time(value):
+    if isinstance(value, list):
+        return value[0]
+    if isinstance(value, float):
+        return value
+    return float(value.split(" ")[0])
+
+
+def format_ms(value):
+    return "-" if value is None else "%.3f" % value
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Nodes(object):
+    """
+    Creates nodes on the chosen transport and polls them
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.nodes = []
+        self.network = MemoryNetwork() if transport == 'memory' else None
+        self.seed = None
+
+    def create(self, cls=ZOCP):
+        if self.transport == 'memory':
+            node = cls(transport=self.network.transport())
+        elif self.transport == 'static':
+            transport = StaticTransport("tcp://127.0.0.1:*", [self.seed] if self.seed else [])
+            node = cls(transport=transport)
+        else:
+            node = cls()
+        # measure the transport, not the handing over within this process
+        node.local_delivery = False
+        self.nodes.append(node)
+        return node
+
+    def start(self, node):
+        node.start()
+        if self.transport == 'static' and self.seed is None:
+            self.seed = node._transport.address
+
+    def poll(self):
+        for node in self.nodes:
+            node.run_once(0)
+
+    def wait(self, done, timeout=10.0):
+        """
+        Poll the nodes until done() returns True, raises RuntimeError
+        after timeout seconds
+        """
+        end = time.time() + timeout
+        while not done():
+            if time.time() > end:
+                raise RuntimeError("timeout waiting for the nodes")
+            self.poll()
+            time.sleep(0.001)
+
+    def stop(self):
+        for node in self.nodes:
+            node.stop()
+        if self.network is not None:
+            self.network.close()
+
+
+def bench_signals(transport, peers, fanout, type_hint, count, size):
+    """
+    Emit count signals of type_hint to fanout receivers on each of
+    peers nodes and return the throughput and latency
+    """
+    nodes = Nodes(transport)
+    try:
+        emitter = nodes.create()
+        getattr(emitter, PAYLOADS[type_hint])("out", payload(type_hint, size), 're')
+        nodes.start(emitter)
+        receivers = []
+        for i in range(peers):
+            node = nodes.create(Receiver)
+            for j in range(fanout):
+                getattr(node, PAYLOADS[type_hint])("in%d" % j, payload(type_hint, size), 'rws')
+            nodes.start(node)
+            receivers.append(node)
+        emit_id = emitter.get_uuid()
+        nodes.wait(lambda: all("out" in node.peers_capabilities.get(emit_id, {})
+                               for node in receivers))
+        for node in receivers:
+            node.signal_subscribe_many([(node.get_uuid(), "in%d" % j, emit_id, "out")
+                                        for j in range(fanout)])
+        nodes.wait(lambda: len(emitter.capability["out"]["subscribers"]) == peers * fanout)
+
+        start = time.time()
+        for i in range(count):
+            emitter.emit_signal("out", payload(type_hint, size))
+            if i % 10 == 9:
+                nodes.poll()
+        try:
+            nodes.wait(lambda: sum(len(node.latencies) for node in receivers) >= count * peers)
+        except RuntimeError:
+            pass
+        latencies = [latency for node in receivers for latency in node.latencies]
+        received = len(latencies)
+        elapsed = max(max(node.last_received for node in receivers) - start, 1e-9)
+        return {
+            'peers': peers,
+            'fanout': fanout,
+            'type': type_hint,
+            'count': count,
+            'received': received,
+            'msgs_per_s': received / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+            'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+        }
+    finally:
+        nodes.stop()
+
+
+def bench_capability(transport, params, reps):
+    """
+    Measure getting a capability of params parameters and modifying it
+    """
+    nodes = Nodes(transport)
+    try:
+        owner = nodes.create()
+        for i in range(params):
+            owner.register_float("param%d" % i, float(i), 'rw')
+        nodes.start(owner)
+        peer = nodes.create()
+        nodes.start(peer)
+        owner_id = owner.get_uuid()
+        nodes.wait(lambda: len(peer.peers_capabilities.get(owner_id, {})) >= params, 60.0)
+
+        before_rep = peer.get_metrics()['methods'].get('REP', {'bytes_in': 0})['bytes_in']
+        get_times = []
+        for i in range(reps):
+            start = time.time()
+            future = peer.peer_get_capability(owner_id)
+            nodes.wait(future.done, 60.0)
+            get_times.append(time.time() - start)
+        get_bytes = (peer.get_metrics()['methods']['REP']['bytes_in'] - before_rep) // reps
+
+        # subscribe to all of the owner, to receive its modifications
+        peer.signal_subscribe(peer.get_uuid(), None, owner_id, None)
+        nodes.wait(lambda: peer.get_uuid() in owner.subscribers)
+        before = peer.get_method_stats().get('MOD', {'count': 0, 'time': 0.0})
+        mod_times = []
+        for i in range(reps):
+            start = time.time()
+            owner.register_float("extra%d" % i, 0.0, 'rw')
+            name = "extra%d" % i
+            nodes.wait(lambda: name in peer.peers_capabilities[owner_id], 60.0)
+            mod_times.append(time.time() - start)
+        after = peer.get_method_stats()['MOD']
+        handled = max(after['count'] - before['count'], 1)
+        return {
+            'params': params,
+            'get_bytes': get_bytes,
+            'get_ms': percentile(get_times, 0.5) * 1000,
+            'mod_ms': percentile(mod_times, 0.5) * 1000,
+            'mod_handler_ms': (after['time'] - before['time']) / handled * 1000,
+        }
+    finally:
+        nodes.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--transport', choices=('static', 'pyre', 'memory'), default='static',
+                        help="transport between the nodes")
+    parser.add_argument('--peers', type=int, nargs='+', default=[1, 4, 16],
+                        help="numbers of subscribed peers")
+    parser.add_argument('--fanout', type=int, nargs='+', default=[1, 8],
+                        help="numbers of receivers per peer")
+    parser.add_argument('--types', nargs='+', choices=PAYLOADS, default=list(PAYLOADS),
+                        help="payload types")
+    parser.add_argument('--count', type=int, default=2000,
+                        help="signals emitted per run")
+    parser.add_argument('--string-size', type=int, default=64,
+                        help="length of string payloads")
+    parser.add_argument('--params', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help="capability sizes for the GET and MOD runs")
+    parser.add_argument('--reps', type=int, default=20,
+                        help="GETs and MODs per capability size")
+    parser.add_argument('--output', help="file to write the JSON results to, default stdout")
+    args = parser.parse_args()
+
+    results = {
+        'benchmark': 'throughput',
+        'transport': args.transport,
+        'python': platform.python_version(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'signals': [],
+        'capability': [],
+    }
+    for peers in args.peers:
+        for fanout in args.fanout:
+            for type_hint in args.types:
+                result = bench_signals(args.transport, peers, fanout, type_hint,
+                                       args.count, args.string_size)
+                sys.stderr.write("signals %s, %d peers, fanout %d: %.0f/s p50 %s ms p99 %s ms\n" % (
+                    type_hint, peers, fanout, result['msgs_per_s'],
+                    format_ms(result['p50_ms']), format_ms(result['p99_ms'])))
+                results['signals'].append(result)
+    for params in args.params:
+        result = bench_capability(args.transport, params, args.reps)
+        sys.stderr.write("capability %(params)d params: GET %(get_ms).2f ms "
+                         "MOD %(mod_ms).2f ms\n" % result)
+        results['capability'].append(result)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+"""
+Measures the capability sync traffic of a ZOCP installation versus its
+number of nodes, with all nodes in one zone and with the nodes spread
+over several zones.
+
+Every node runs in this process, so keep the node counts modest. The
+nodes talk through the in-process MemoryNetwork unless another
+transport is chosen, so runs are repeatable.
+"""
+
+import argparse
+import sys
+import time
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from throughput import Nodes
+
+# methods used to sync capabilities
+SYNC_METHODS = ('GET', 'VER', 'REP', 'MOD')
+
+
+def run(transport, count, zones, settle):
+    """
+    Start count nodes on transport, spread round robin over zones (no
+    zones if 0), and return the number of sync messages handled by all
+    nodes
+    """
+    nodes = Nodes(transport)
+    try:
+        for i in range(count):
+            node = nodes.create()
+            node.set_name("bench%d" % i)
+            if zones:
+                node.set_zones(["zone%d" % (i % zones)])
+            node.register_float("value", 0.0, 'rwe')
+            node.register_vec3f("location", (0.0, 0.0, 0.0), 'rwe')
+            nodes.start(node)
+        end = time.time() + settle
+        while time.time() < end:
+            nodes.poll()
+            time.sleep(0.01)
+        messages = 0
+        for node in nodes.nodes:
+            stats = node.get_method_stats()
+            messages += sum(stats[method]['count'] for method in SYNC_METHODS)
+        return messages
+    finally:
+        nodes.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--transport', choices=('static', 'pyre', 'memory'), default='memory',
+                        help="transport between the nodes")
+    parser.add_argument('--nodes', type=int, nargs='+', default=[4, 8, 16, 32],
+                        help="node counts to measure")
+    parser.add_argument('--zones', type=int, default=4,
+                        help="number of zones to spread the nodes over")
+    parser.add_argument('--settle', type=float, default=3.0,
+                        help="seconds to let the nodes discover each other")
+    args = parser.parse_args()
+
+    print("%8s %14s %14s" % ("nodes", "no zones", "%d zones" % args.zones))
+    for count in args.nodes:
+        flat = run(args.transport, count, 0, args.settle)
+        zoned = run(args.transport, count, args.zones, args.settle)
+        print("%8d %14d %14d" % (count, flat, zoned))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,6 @@ import gi
 from gi.repository import GObject
 
 from zocp import ZOCP
-import zmq
 
 GObject.threads_init()
 loop = GObject.MainLoop()
@@ -12,14 +11,16 @@ z.set_node_name("GLibTest")
 z.register_percent('myPercent', 12, access='rw')
 
 def zocp_handle(*args, **kwargs):
-    z.run_once()
+    z.run_once(0)
     return True
 
 GObject.io_add_watch(
-        z.inbox.getsockopt(zmq.FD), 
+        z.get_fd(), 
         GObject.PRIORITY_DEFAULT, 
         GObject.IO_IN, zocp_handle
     )
+# requests time out when run_once runs
+GObject.timeout_add(100, zocp_handle)
 z.start()
 try:
     loop.run()
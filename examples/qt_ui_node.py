@@ -8,7 +8,6 @@ PyQt5 ZOCP UI Node example
 import sys
 from PyQt5 import QtCore, QtWidgets, QtGui
 from zocp import ZOCP
-import zmq
 
 class QTZOCPNode(QtWidgets.QWidget):
 
@@ -25,11 +24,15 @@ class QTZOCPNode(QtWidgets.QWidget):
         self.z.set_node_name("QT UI TEST")
         self.z.register_float("myFloat", 2.3, 'rw', 0, 5.0, 0.1)
         self.notifier = QtCore.QSocketNotifier(
-                self.z.inbox.getsockopt(zmq.FD), 
+                self.z.get_fd(), 
                 QtCore.QSocketNotifier.Read
                 )
         self.notifier.setEnabled(True)
         self.notifier.activated.connect(self.zocp_event)
+        # requests time out when run_once runs
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.zocp_event)
+        self.timer.start(100)
         self.z.on_modified = self.on_modified
         self.z.start()
 
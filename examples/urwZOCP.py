@@ -33,7 +33,7 @@ def mergedicts(a, b, path=None):
     if path is None: path = []
     for key in b:
         if key in a:
-            if isinstance(a[key], dict) and isinstance(b[key], dict):
+            if isinstance(a[key], (dict, zocp.Parameter)) and isinstance(b[key], (dict, zocp.Parameter)):
                 mergedicts(a[key], b[key], path + [str(key)])
             else:
                 a[key] = b[key]
@@ -762,9 +762,16 @@ class urwZOCP(zocp.ZOCP):
         if nd:
             nd[0].original_widget.update()
 
+    def _tick(self, loop, user_data):
+        # requests time out when run_once runs
+        self.run_once(0)
+        loop.set_alarm_in(0.1, self._tick)
+
     def run(self):
         self.start()
-        handle = self.loop.watch_file(self.inbox, self.get_message)
+        # the fd also covers work handed to the loop by other threads
+        handle = self.loop.watch_file(self.get_fd(), lambda: self.run_once(0))
+        self.loop.set_alarm_in(0.1, self._tick)
         self._running = True
         self.loop.run()
         self.stop()
@@ -19,10 +19,232 @@ from pyre import Pyre
 import json
 import zmq
 import uuid
+import copy
+import re
+import time
+import itertools
+import bisect
+import heapq
+import random
+import select
+import functools
+import threading
+import collections
+import weakref
 import logging
+try:
+    from collections.abc import MutableMapping, MutableSet
+except ImportError:
+    from collections import MutableMapping, MutableSet
+try:
+    from sys import intern
+except ImportError:
+    pass
+from concurrent.futures import Future, TimeoutError, ThreadPoolExecutor
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 logger = logging.getLogger(__name__)
 
+# high resolution timer for profiling, time.time on older pythons
+_clock = getattr(time, 'perf_counter', time.time)
+
+class Parameter(MutableMapping):
+    """
+    Record of a parameter in a capability tree
+
+    Behaves like the dictionary it replaces, i.e. {'value': 1.0,
+    'typeHint': 'flt', 'access': 'rw', 'subscribers': []}, but keeps
+    the common fields in slots instead of a per parameter dict. Other
+    keys are stored in an extra dict, created when first needed.
+    """
+    __slots__ = ('value', 'typeHint', 'access', 'subscribers', 'min', 'max', 'step', '_extra')
+
+    _fields = ('value', 'typeHint', 'access', 'subscribers', 'min', 'max', 'step')
+    _field_set = frozenset(_fields)
+    # fields shared by many parameters
+    _interned = frozenset(('typeHint', 'access'))
+
+    def __init__(self, data=None, **kwargs):
+        self._extra = None
+        if data:
+            self.update(data)
+        if kwargs:
+            self.update(kwargs)
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._field_set:
+            if key in self._interned and isinstance(value, str):
+                value = intern(value)
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._field_set:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key in self._field_set:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for key in self._fields:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        return Parameter(self)
+
+    def to_dict(self):
+        """
+        returns the parameter as a plain dict, i.e. for json.dumps
+        """
+        return dict((key, list(value) if isinstance(value, OrderedSet) else value)
+                    for key, value in self.items())
+
+class OrderedSet(MutableSet):
+    """
+    Set remembering the order in which items were added, used for the
+    bookkeeping of subscribers. It is sent as a list and compares equal
+    to a list or tuple of the same items in the same order.
+    """
+    __slots__ = ('_items',)
+
+    def __init__(self, items=()):
+        self._items = collections.OrderedDict()
+        for item in items:
+            self._items[item] = None
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item):
+        self._items[item] = None
+
+    def discard(self, item):
+        self._items.pop(item, None)
+
+    def update(self, items):
+        for item in items:
+            self._items[item] = None
+
+    # list compatibility
+    append = add
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return MutableSet.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "%s(%r)" %(self.__class__.__name__, list(self))
+
+def param_subscribers(param):
+    """
+    returns the subscribers of one of our parameters as an OrderedSet,
+    converting a list of subscribers, i.e. of a capability set from a
+    file
+    """
+    subscribers = param.get('subscribers')
+    if not isinstance(subscribers, OrderedSet):
+        subscribers = OrderedSet(tuple(s) if isinstance(s, list) else s
+                                 for s in subscribers or ())
+        param['subscribers'] = subscribers
+    return subscribers
+
+def is_param(d):
+    """
+    returns True if d is a parameter in a capability tree, a Parameter
+    or a dict containing a 'value'
+    """
+    return isinstance(d, Parameter) or (isinstance(d, dict) and 'value' in d)
+
+def compact_params(d):
+    """
+    replaces the parameter dicts in the nested dict d by Parameter
+    records, returns d
+    """
+    for key, value in d.items():
+        if isinstance(value, dict):
+            if 'value' in value or 'typeHint' in value:
+                param = d[key] = Parameter(value)
+                if param.get('subscribers') == []:
+                    # share one empty sequence between all parameters
+                    param['subscribers'] = ()
+            else:
+                compact_params(value)
+    return d
+
+def plain_dict(d):
+    """
+    returns a copy of the nested dict d holding plain dicts instead of
+    Parameter records, i.e. for json.dumps
+    """
+    ret = {}
+    for key, value in d.items():
+        if isinstance(value, Parameter):
+            value = value.to_dict()
+        elif isinstance(value, dict):
+            value = plain_dict(value)
+        ret[key] = value
+    return ret
+
+def _to_json(obj):
+    if isinstance(obj, Parameter):
+        return obj.to_dict()
+    if isinstance(obj, OrderedSet):
+        return list(obj)
+    raise TypeError("%r is not JSON serializable" %obj)
+
+def encode_message(msg):
+    """
+    returns the encoded JSON of a ZOCP message
+    """
+    return json.dumps(msg, default=_to_json).encode('utf-8')
+
 def dict_get(d, keys):
     """
     returns a value from a nested dict
@@ -48,7 +270,7 @@ def dict_set(d, keys, value):
 
 def dict_get_keys(d, keylist=""):
     for k, v in d.items():
-        if isinstance(v, dict):
+        if isinstance(v, (dict, Parameter)):
             # entering branch add seperator and enter
             keylist=keylist+".%s" %k
             keylist = dict_get_keys(v, keylist)
@@ -58,17 +280,68 @@ def dict_get_keys(d, keylist=""):
             #print(keylist)
     return keylist
 
+def dict_walk_params(tree, data, keys=()):
+    """
+    yields (keys, parameter) for every parameter in the nested dict tree
+    which is part of the partial dict data. A parameter is a dict
+    containing a 'value', keys is the tuple of keys leading to it
+    """
+    for key, sub in data.items():
+        node = tree.get(key)
+        if is_param(node):
+            yield keys + (key,), node
+        elif isinstance(node, dict) and isinstance(sub, (dict, Parameter)):
+            for item in dict_walk_params(node, sub, keys + (key,)):
+                yield item
+
+def dict_changes_values(tree, data):
+    """
+    returns True if the partial dict data only changes the values of
+    parameters existing in the nested dict tree
+    """
+    for key, sub in data.items():
+        node = tree.get(key)
+        if is_param(node):
+            if not isinstance(sub, (dict, Parameter)) or list(sub.keys()) != ['value']:
+                return False
+        elif not isinstance(node, dict) or not isinstance(sub, dict) \
+                or not dict_changes_values(node, sub):
+            return False
+    return True
+
+_patterns = {}
+
+def is_pattern(name):
+    """
+    returns True if the emitter name is a glob pattern, i.e.
+    'objects.Camera*.location' or '*_location'. Only '*' and '?' are
+    wildcards, brackets are part of names like 'points[0]'.
+    """
+    if not name:
+        return False
+    return '*' in name or '?' in name
+
+def compile_pattern(pattern):
+    """
+    returns the compiled regular expression of a glob pattern
+    """
+    regex = _patterns.get(pattern)
+    if regex is None:
+        regex = re.escape(pattern).replace(r'\*', '.*').replace(r'\?', '.')
+        regex = _patterns[pattern] = re.compile(r'(?s)%s\Z' %regex)
+    return regex
+
 # http://stackoverflow.com/questions/38987/how-can-i-merge-union-two-python-dictionaries-in-a-single-expression?rq=1
 def dict_merge(a, b, path=None):
     """
     merges b into a, overwites a with b if equal
     """
-    if not isinstance(a, dict):
+    if not isinstance(a, (dict, Parameter)):
         return b
     if path is None: path = []
     for key in b.keys():
         if key in a:
-            if isinstance(a[key], dict) and isinstance(b[key], dict):
+            if isinstance(a[key], (dict, Parameter)) and isinstance(b[key], (dict, Parameter)):
                 dict_merge(a[key], b[key], path + [str(key)])
             else:
                 a[key] = b[key]
@@ -76,22 +349,1337 @@ def dict_merge(a, b, path=None):
             a[key] = b[key]
     return a
 
+def _same_value(a, b):
+    # JSON turns tuples into lists, compare sequences by their items
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(_same_value(x, y) for x, y in zip(a, b))
+    return a == b
+
+def dict_merge_diff(a, b):
+    """
+    merges b into a and returns the part of b which actually changed a,
+    an empty dict if merging b changed nothing
+    """
+    diff = {}
+    for key, value in b.items():
+        if key in a:
+            old = a[key]
+            if isinstance(old, (dict, Parameter)) and isinstance(value, (dict, Parameter)):
+                changed = dict_merge_diff(old, value)
+                if changed:
+                    diff[key] = changed
+                continue
+            if _same_value(old, value):
+                continue
+        a[key] = value
+        diff[key] = value
+    return diff
+
+class FrozenDict(dict):
+    """
+    Read-only dict used for the parts of a snapshot
+    """
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("%s is read-only" %self.__class__.__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+def freeze(obj):
+    """
+    returns a read-only copy of a capability tree, dicts and parameters
+    become FrozenDicts and lists become tuples
+    """
+    if isinstance(obj, FrozenDict):
+        return obj
+    if isinstance(obj, (dict, Parameter)):
+        return FrozenDict((key, freeze(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple, OrderedSet)):
+        return tuple(freeze(value) for value in obj)
+    return obj
+
+def _refreeze(frozen, tree, paths):
+    # returns a frozen copy of tree, sharing everything outside of the
+    # modified key paths with the previous frozen copy
+    if not isinstance(frozen, FrozenDict) or () in paths \
+            or not isinstance(tree, (dict, Parameter)):
+        return freeze(tree)
+    children = {}
+    for path in paths:
+        children.setdefault(path[0], set()).add(path[1:])
+    new = dict(frozen)
+    for key, child_paths in children.items():
+        if key in tree:
+            new[key] = _refreeze(frozen.get(key), tree[key], child_paths)
+        else:
+            new.pop(key, None)
+    return FrozenDict(new)
+
+def dict_walk_types(data, keys=()):
+    """
+    yields the keys of all objects in the nested dict data which have
+    a 'type' key, i.e. objects which changed type in a modification
+    """
+    for key, sub in data.items():
+        if isinstance(sub, dict) and not is_param(sub):
+            if 'type' in sub:
+                yield keys + (key,)
+            for item in dict_walk_types(sub, keys + (key,)):
+                yield item
+
+class RoutingGraph(object):
+    """
+    Graph of the signal routes between parameters, built from the
+    subscribers advertised in capabilities. Vertices are (peer hex,
+    dotted path) tuples, an edge runs from an emitter to a receiver.
+    """
+    def __init__(self):
+        # vertex : OrderedSet of vertices it signals
+        self.edges = collections.OrderedDict()
+
+    def add_capability(self, peer_hex, capability):
+        """
+        Add the routes from the parameters of a capability
+        """
+        for keys, param in dict_walk_params(capability, capability):
+            for subscriber in param.get('subscribers') or ():
+                recv_hex, receiver = subscriber
+                # subscriptions without receiver don't propagate
+                if receiver is not None:
+                    self.edges.setdefault((peer_hex, ".".join(keys)), OrderedSet()).add((recv_hex, receiver))
+
+    def hops(self, source):
+        """
+        Return a dict of vertex : number of hops for all vertices a
+        signal from source reaches
+        """
+        distances = {source: 0}
+        queue = collections.deque([source])
+        while queue:
+            vertex = queue.popleft()
+            for target in self.edges.get(vertex, ()):
+                if target not in distances:
+                    distances[target] = distances[vertex] + 1
+                    queue.append(target)
+        return distances
+
+    def find_cycles(self):
+        """
+        Return a list of the cycles in the graph, each a list of the
+        vertices which signal each other
+        """
+        # iterative version of Tarjan's strongly connected components
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        cycles = []
+        counter = itertools.count()
+        for root in list(self.edges):
+            if root in index:
+                continue
+            index[root] = low[root] = next(counter)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self.edges.get(root, ())))]
+            while work:
+                vertex, targets = work[-1]
+                for target in targets:
+                    if target not in index:
+                        index[target] = low[target] = next(counter)
+                        stack.append(target)
+                        on_stack.add(target)
+                        work.append((target, iter(self.edges.get(target, ()))))
+                        break
+                    elif target in on_stack:
+                        low[vertex] = min(low[vertex], index[target])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[vertex])
+                    if low[vertex] == index[vertex]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == vertex:
+                                break
+                        if len(component) > 1 or vertex in self.edges.get(vertex, ()):
+                            cycles.append(component[::-1])
+        return cycles
+
+# consistent, read-only view of a node's capability and those of its peers
+Snapshot = collections.namedtuple('Snapshot', ['capability', 'peers_capabilities', 'version'])
+
+class LazyCapability(dict):
+    """
+    Capability of a peer kept as the raw MOD messages it was sent in
+
+    A message is decoded when the capability is first accessed, but
+    only the top level keys that are accessed are merged, the others
+    are kept as pending patches until they are accessed too. loader is
+    called with every patch, the default merges it into the dict itself.
+    """
+    def __init__(self, data=(), loader=None):
+        dict.__init__(self, data)
+        self.loader = loader
+        self._pending = []
+        # top level key : list of decoded values to merge
+        self._patches = collections.OrderedDict()
+
+    def add_message(self, raw):
+        """
+        Add the raw bytes of a MOD message to merge on access
+        """
+        self._pending.append(raw)
+
+    def is_loaded(self):
+        """
+        Returns True if no messages are waiting to be decoded or merged
+        """
+        return not self._pending and not self._patches
+
+    def raw_size(self):
+        """
+        Returns the number of bytes of the messages waiting to be decoded
+        """
+        return sum(len(raw) for raw in self._pending)
+
+    def load(self, keys=None):
+        """
+        Decode the pending messages and merge the patches of keys, of
+        all keys if keys is None
+        """
+        pending, self._pending = self._pending, []
+        for raw in pending:
+            for key, value in json.loads(raw.decode('utf-8'))['MOD'].items():
+                self._patches.setdefault(key, []).append(value)
+        for key in list(self._patches) if keys is None else keys:
+            # merging accesses the dict again, so take the patches first
+            for value in self._patches.pop(key, ()):
+                if self.loader is None:
+                    dict_merge(self, compact_params({key: value}))
+                else:
+                    self.loader({key: value})
+
+def _loading(name, keyed=False):
+    method = getattr(dict, name)
+    def wrapper(self, *args, **kwargs):
+        if self._pending or self._patches:
+            self.load([args[0]] if keyed and args else None)
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ('__getitem__', '__setitem__', '__delitem__', '__contains__',
+              'get', 'setdefault', 'pop', 'has_key'):
+    if hasattr(dict, _name):
+        setattr(LazyCapability, _name, _loading(_name, keyed=True))
+
+for _name in ('__iter__', '__len__', '__eq__', '__ne__', '__repr__',
+              'keys', 'items', 'values', 'copy', 'popitem', 'update',
+              'iterkeys', 'iteritems', 'itervalues'):
+    if hasattr(dict, _name):
+        setattr(LazyCapability, _name, _loading(_name))
+
+class PeerCache(object):
+    """
+    Least recently used cache of the state of departed peers, bounded
+    by the number of peers and by the estimated size of their state in
+    bytes
+    """
+    def __init__(self, max_peers=32, max_bytes=1 << 20):
+        self.max_peers = max_peers
+        self.max_bytes = max_bytes
+        # estimated bytes of all cached states
+        self.size = 0
+        # peer : (state, size), oldest first
+        self._entries = collections.OrderedDict()
+
+    def put(self, peer, state, size):
+        """
+        Cache the state of a peer, evicting the oldest entries when
+        over the limits
+        """
+        self.pop(peer)
+        if size > self.max_bytes:
+            return
+        self._entries[peer] = (state, size)
+        self.size += size
+        while len(self._entries) > self.max_peers or self.size > self.max_bytes:
+            old_peer, (old_state, old_size) = self._entries.popitem(last=False)
+            self.size -= old_size
+
+    def pop(self, peer):
+        """
+        Remove and return the cached state of a peer, None if unknown
+        """
+        entry = self._entries.pop(peer, None)
+        if entry is None:
+            return None
+        self.size -= entry[1]
+        return entry[0]
+
+    def __contains__(self, peer):
+        return peer in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+class ParamIndex(object):
+    """
+    Index of the parameters of peers by name, typeHint, access flag and
+    the type of the object they belong to
+
+    Lookups cost in the order of the number of results instead of
+    walking all capabilities.
+    """
+    fields = ('name', 'typeHint', 'access', 'type')
+
+    def __init__(self):
+        # (field, value) : set of (peer, path)
+        self._index = {}
+        # (peer, path) : list of (field, value) the parameter is indexed by
+        self._entries = {}
+        # peer : set of indexed paths
+        self._peer_paths = {}
+
+    def add(self, peer, keys, param, obj_type=None):
+        """
+        Index or reindex a parameter of a peer at keys
+        """
+        path = ".".join(keys)
+        self.remove(peer, path)
+        entries = [('name', keys[-1])]
+        if param.get('typeHint') is not None:
+            entries.append(('typeHint', param['typeHint']))
+        for flag in set(param.get('access') or ''):
+            entries.append(('access', flag))
+        if obj_type is not None:
+            entries.append(('type', obj_type))
+        for entry in entries:
+            self._index.setdefault(entry, set()).add((peer, path))
+        self._entries[(peer, path)] = entries
+        self._peer_paths.setdefault(peer, set()).add(path)
+
+    def remove(self, peer, path):
+        """
+        Remove a parameter of a peer from the index
+        """
+        entries = self._entries.pop((peer, path), None)
+        if entries is None:
+            return
+        for entry in entries:
+            items = self._index[entry]
+            items.discard((peer, path))
+            if not items:
+                del self._index[entry]
+        self._peer_paths[peer].discard(path)
+
+    def remove_peer(self, peer):
+        """
+        Remove all parameters of a peer from the index
+        """
+        for path in list(self._peer_paths.get(peer, ())):
+            self.remove(peer, path)
+        self._peer_paths.pop(peer, None)
+
+    def find(self, name=None, typeHint=None, access=None, type=None):
+        """
+        Return the set of (peer, path) of all parameters matching all
+        given criteria. access matches parameters having all the given
+        flags, i.e. 'w' also matches 'rw'.
+        """
+        keys = []
+        if name is not None:
+            keys.append(('name', name))
+        if typeHint is not None:
+            keys.append(('typeHint', typeHint))
+        for flag in set(access or ''):
+            keys.append(('access', flag))
+        if type is not None:
+            keys.append(('type', type))
+        if not keys:
+            return set(self._entries)
+        sets = sorted((self._index.get(key, set()) for key in keys), key=len)
+        return sets[0].intersection(*sets[1:])
+
+class ValueStore(object):
+    """
+    Columnar store of numeric parameter values
+
+    Values of parameters added to the store are kept in one NumPy array
+    per typeHint, one row per parameter. Applications write the values
+    using set() or directly into the arrays returned by column(), after
+    which emit_changed() compares all values against the last emitted
+    ones at once and signals only the changed parameters.
+
+    The value in the capability tree is updated when a value is emitted.
+    Requires NumPy.
+    """
+    # typeHint : (number of columns, dtype)
+    layouts = {
+        'int':     (1, 'int64'),
+        'bool':    (1, 'bool'),
+        'flt':     (1, 'float64'),
+        'percent': (1, 'float64'),
+        'vec2f':   (2, 'float64'),
+        'vec3f':   (3, 'float64'),
+        'vec4f':   (4, 'float64'),
+    }
+
+    def __init__(self, node):
+        if numpy is None:
+            raise ImportError("ValueStore requires numpy")
+        self.node = node
+        # typeHint : array of current values
+        self._columns = {}
+        # typeHint : array of the last emitted values
+        self._emitted = {}
+        # typeHint : list of paths, in row order
+        self._paths = {}
+        # path : (typeHint, row)
+        self._rows = {}
+
+    def add(self, path):
+        """
+        Add a registered parameter to the store by its dotted path
+        """
+        if path in self._rows:
+            return
+        param = self.node._get_param(path)[1]
+        type_hint = param['typeHint']
+        if type_hint not in self.layouts:
+            raise ValueError("Can't store %s parameters" %type_hint)
+        width, dtype = self.layouts[type_hint]
+        paths = self._paths.setdefault(type_hint, [])
+        row = len(paths)
+        columns = self._columns.get(type_hint)
+        if columns is None or row == len(columns):
+            # grow by doubling so adding n parameters is O(n)
+            size = max(16, row * 2)
+            new_columns = numpy.zeros((size, width), dtype=dtype)
+            new_emitted = numpy.zeros((size, width), dtype=dtype)
+            if columns is not None:
+                new_columns[:row] = columns[:row]
+                new_emitted[:row] = self._emitted[type_hint][:row]
+            self._columns[type_hint] = columns = new_columns
+            self._emitted[type_hint] = new_emitted
+        columns[row] = param['value']
+        self._emitted[type_hint][row] = param['value']
+        paths.append(path)
+        self._rows[path] = (type_hint, row)
+
+    def set(self, path, value):
+        """
+        Set the value of a parameter in the store, it is signalled by
+        the next call to emit_changed
+        """
+        type_hint, row = self._rows[path]
+        self._columns[type_hint][row] = value
+
+    def get(self, path):
+        """
+        Return the current value of a parameter in the store
+        """
+        type_hint, row = self._rows[path]
+        return self._to_value(self._columns[type_hint][row])
+
+    def column(self, type_hint):
+        """
+        Return the array of values of a typeHint, one row per parameter
+        in the order of paths(type_hint). Writes to the array are
+        signalled by the next call to emit_changed.
+        """
+        return self._columns[type_hint][:len(self._paths[type_hint])]
+
+    def paths(self, type_hint):
+        """
+        Return the paths of the parameters of a typeHint in row order
+        """
+        return list(self._paths.get(type_hint, ()))
+
+    def changed(self):
+        """
+        Return a list of (path, value) of the parameters changed since
+        they were last emitted
+        """
+        changes = []
+        for type_hint, paths in self._paths.items():
+            count = len(paths)
+            current = self._columns[type_hint][:count]
+            emitted = self._emitted[type_hint][:count]
+            differs = current != emitted
+            if current.dtype.kind in 'fc':
+                # NaN never equals itself, which would report it forever
+                differs &= ~(numpy.isnan(current) & numpy.isnan(emitted))
+            # comparing flat is much faster than reducing along the rows
+            rows = numpy.flatnonzero(differs)
+            width = current.shape[1]
+            if width > 1:
+                rows = numpy.unique(rows // width)
+            for row in rows:
+                changes.append((paths[row], self._to_value(current[row])))
+        return changes
+
+    def emit_changed(self):
+        """
+        Signal all parameters changed since they were last emitted,
+        using one message per subscriber. Returns the number of changed
+        parameters.
+        """
+        changes = self.changed()
+        if changes:
+            self.node.emit_signals(changes)
+            for type_hint, paths in self._paths.items():
+                count = len(paths)
+                self._emitted[type_hint][:count] = self._columns[type_hint][:count]
+        return len(changes)
+
+    def _to_value(self, row):
+        if len(row) == 1:
+            return row[0].item()
+        return row.tolist()
+
+class Histogram(object):
+    """
+    Histogram of durations in seconds, in buckets doubling in size from
+    a microsecond up to about 16 seconds
+    """
+    BOUNDS = [1e-6 * 2 ** i for i in range(25)]
+
+    def __init__(self):
+        # the last bucket counts durations beyond the bounds
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """
+        Return the upper bound of the bucket holding the fraction of
+        the durations, None if there are none
+        """
+        if not self.count:
+            return None
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= fraction * self.count and count:
+                if bucket < len(self.BOUNDS):
+                    return min(self.BOUNDS[bucket], self.max)
+                return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'time': self.total,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'buckets': [[bound, count] for bound, count in
+                        zip(self.BOUNDS + [None], self.counts) if count],
+        }
+
+def _counters(table, key):
+    counters = table.get(key)
+    if counters is None:
+        counters = table[key] = [0, 0, 0, 0]
+    return counters
+
+class Metrics(object):
+    """
+    Counters of the messages a node sends and receives, per method,
+    per peer and per emitter, and histograms of the time spent
+    dispatching messages and running callbacks
+    """
+
+    def __init__(self):
+        # method : [messages in, bytes in, messages out, bytes out]
+        self.methods = {}
+        # peer id : [messages in, bytes in, messages out, bytes out]
+        self.peers = {}
+        # emitter : signals sent
+        self.emitted = {}
+        # peer id : {emitter : signals received}
+        self.received = {}
+        # counters of the peers which exited, kept for the totals
+        self.departed = [0, 0, 0, 0]
+        self.dispatch = Histogram()
+        self.callbacks = Histogram()
+        # callbacks may be timed on the threads of an executor
+        self._lock = threading.Lock()
+
+    def message_in(self, peer, methods, size):
+        counters = _counters(self.peers, peer)
+        counters[0] += 1
+        counters[1] += size
+        for method in methods:
+            counters = _counters(self.methods, method)
+            counters[0] += 1
+            counters[1] += size
+
+    def message_out(self, peer, method, size):
+        for counters in (_counters(self.peers, peer), _counters(self.methods, method)):
+            counters[2] += 1
+            counters[3] += size
+
+    def signals_out(self, signals):
+        for emitter, value in signals:
+            self.emitted[emitter] = self.emitted.get(emitter, 0) + 1
+
+    def signal_in(self, peer, emitter):
+        received = self.received.get(peer)
+        if received is None:
+            received = self.received[peer] = {}
+        received[emitter] = received.get(emitter, 0) + 1
+
+    def remove_peer(self, peer):
+        """
+        Drop the counters of an exited peer, keeping them in the totals
+        """
+        for i, count in enumerate(self.peers.pop(peer, ())):
+            self.departed[i] += count
+        self.received.pop(peer, None)
+
+    def callback_time(self, seconds):
+        with self._lock:
+            self.callbacks.observe(seconds)
+
+    def totals(self):
+        """
+        Return the number of messages and bytes in and out of all peers,
+        including the peers which exited
+        """
+        totals = list(self.departed)
+        for counters in self.peers.values():
+            for i, count in enumerate(counters):
+                totals[i] += count
+        return dict(zip(('messages_in', 'bytes_in', 'messages_out', 'bytes_out'), totals))
+
+    def to_dict(self):
+        def counts(counters):
+            return dict(zip(('messages_in', 'bytes_in', 'messages_out', 'bytes_out'), counters))
+        with self._lock:
+            callbacks = self.callbacks.to_dict()
+        return {
+            'totals': self.totals(),
+            'methods': dict((method, counts(c)) for method, c in self.methods.items()),
+            'peers': dict((peer, counts(c)) for peer, c in self.peers.items()),
+            'emitters': dict(self.emitted),
+            'peer_emitters': dict((peer, dict(r)) for peer, r in self.received.items()),
+            'dispatch': self.dispatch.to_dict(),
+            'callbacks': callbacks,
+        }
+
+# prefix of the groups of zones
+ZONE_PREFIX = "ZOCP/"
+# version of the protocol advertised in the X-ZOCP-PROTO header, peers
+# from version 2 on know the batched SUBS and UNSUBS
+ZOCP_PROTOCOL = 2
+# a message starting with a MOD, whatever the spacing of the sender
+_LAZY_MOD = re.compile(br'\s*\{\s*"MOD"\s*:')
+
+# node id : running ZOCP nodes in this process, for local delivery
+_local_nodes = weakref.WeakValueDictionary()
+
+def _copy_value(value):
+    # local delivery skips JSON, so don't share mutable values
+    if isinstance(value, (list, dict)):
+        return copy.deepcopy(value)
+    return value
+
+class StaticTransport(object):
+    """
+    Transport connecting directly to known endpoints, instead of
+    discovering peers through UDP beacons like Pyre
+
+    The node binds a ROUTER socket at endpoint, 'tcp://127.0.0.1:*'
+    binds a free port, and says hello to each of the peer endpoints
+    when started. Peers reply with the endpoints of the peers they
+    know, so a single seed endpoint is enough to find the others. Peers
+    ping each other every heartbeat seconds and are considered gone
+    when nothing was heard from them for expiry seconds. When binding
+    to all interfaces, pass the address other peers reach this node at.
+
+    It implements the part of the Pyre API used by ZOCP, and delivers
+    the same events in its inbox, so a node can use it instead of Pyre:
+
+        node = ZOCP(transport=StaticTransport("tcp://*:5670", ["tcp://10.0.0.1:5670"]))
+    """
+
+    def __init__(self, endpoint, peers=(), ctx=None, address=None, heartbeat=1.0, expiry=5.0):
+        self.ctx = ctx or zmq.Context.instance()
+        self.endpoint = endpoint
+        # endpoint peers connect to, defaults to the bound endpoint
+        self.address = address
+        self.heartbeat = heartbeat
+        self.expiry = expiry
+        self._seeds = list(peers)
+        self._uuid = uuid.uuid4()
+        self._name = self._uuid.hex[:6]
+        self._headers = {}
+        self._groups = set()
+        # peer id : {'endpoint', 'name', 'headers', 'groups', 'seen'}
+        self._peers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        addr = "inproc://zocp-static-%s" % self._uuid.hex
+        self.inbox = self.ctx.socket(zmq.PAIR)
+        self.inbox.bind(addr)
+        self._outbox = self.ctx.socket(zmq.PAIR)
+        self._outbox.connect(addr)
+        self._pipe = self.ctx.socket(zmq.PAIR)
+        self._pipe.bind(addr + "-pipe")
+        self._pipe_lock = threading.Lock()
+
+    #########################################
+    # Pyre API
+    #########################################
+    def get_uuid(self):
+        return self._uuid
+
+    def get_name(self):
+        return self._name
+
+    def set_name(self, name):
+        self._name = name
+
+    def set_header(self, key, value):
+        self._headers[key] = value
+
+    def get_peers(self):
+        with self._lock:
+            return list(self._peers)
+
+    def get_peer_address(self, peer):
+        with self._lock:
+            return self._peers[peer]['endpoint']
+
+    def get_peer_header_value(self, peer, key):
+        with self._lock:
+            return self._peers[peer]['headers'].get(key)
+
+    def get_own_groups(self):
+        return list(self._groups)
+
+    def get_peer_groups(self):
+        with self._lock:
+            groups = set()
+            for info in self._peers.values():
+                groups.update(info['groups'])
+            return list(groups)
+
+    def join(self, group):
+        with self._lock:
+            self._groups.add(group)
+        self._command(b"JOIN", group.encode('utf-8'))
+
+    def leave(self, group):
+        with self._lock:
+            self._groups.discard(group)
+        self._command(b"LEAVE", group.encode('utf-8'))
+
+    def whisper(self, peer, msg):
+        self._command(b"WHISPER", peer.bytes, msg)
+
+    def shout(self, group, msg):
+        self._command(b"SHOUT", group.encode('utf-8'), msg)
+
+    def recv(self):
+        return self.inbox.recv_multipart()
+
+    def start(self):
+        router = self.ctx.socket(zmq.ROUTER)
+        router.setsockopt(zmq.LINGER, 0)
+        router.bind(self.endpoint)
+        self.endpoint = router.getsockopt(zmq.LAST_ENDPOINT).decode('utf-8')
+        if self.address is None:
+            self.address = self.endpoint.replace("0.0.0.0", "127.0.0.1")
+        pipe = self.ctx.socket(zmq.PAIR)
+        pipe.connect("inproc://zocp-static-%s-pipe" % self._uuid.hex)
+        self._thread = threading.Thread(target=self._run, args=(router, pipe))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._command(b"STOP")
+            self._thread.join()
+            self._thread = None
+        self._pipe.close(linger=0)
+        self._outbox.close(linger=0)
+        self.inbox.close(linger=0)
+
+    def _command(self, *frames):
+        if self._thread is None:
+            # not started yet, the hello carries our groups
+            return
+        frames = [f if isinstance(f, bytes) else f.encode('utf-8') for f in frames]
+        with self._pipe_lock:
+            self._pipe.send_multipart(frames)
+
+    #########################################
+    # Transport thread
+    #########################################
+    def _run(self, router, pipe):
+        # endpoint : dealer socket to the peer at the endpoint
+        self._dealers = {}
+        # endpoint : peer id, once the peer said hello
+        self._endpoint_peers = {}
+        for endpoint in self._seeds:
+            self._connect(endpoint)
+        poller = zmq.Poller()
+        poller.register(router, zmq.POLLIN)
+        poller.register(pipe, zmq.POLLIN)
+        ping_at = time.time() + self.heartbeat
+        while True:
+            items = dict(poller.poll(max(0, int((ping_at - time.time()) * 1000))))
+            if items.get(pipe) == zmq.POLLIN:
+                if not self._handle_command(pipe.recv_multipart()):
+                    break
+            if items.get(router) == zmq.POLLIN:
+                frames = router.recv_multipart()
+                self._handle_peer_message(uuid.UUID(bytes=frames[0]), frames[1:])
+            if time.time() >= ping_at:
+                self._ping()
+                ping_at = time.time() + self.heartbeat
+        for dealer in self._dealers.values():
+            self._send(dealer, b"BYE")
+            dealer.close(linger=100)
+        router.close(linger=0)
+        pipe.close(linger=0)
+
+    def _connect(self, endpoint):
+        if endpoint == self.address or endpoint in self._dealers:
+            return
+        dealer = self.ctx.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.IDENTITY, self._uuid.bytes)
+        dealer.setsockopt(zmq.LINGER, 0)
+        dealer.connect(endpoint)
+        self._dealers[endpoint] = dealer
+        self._hello(dealer)
+
+    def _hello(self, dealer):
+        with self._lock:
+            groups = sorted(self._groups)
+        self._send(dealer, b"HELLO", self.address, self._name,
+                   json.dumps(self._headers), json.dumps(groups))
+
+    def _send(self, dealer, *frames):
+        frames = [f if isinstance(f, bytes) else f.encode('utf-8') for f in frames]
+        try:
+            dealer.send_multipart(frames, zmq.NOBLOCK)
+        except zmq.Again:
+            logger.debug("ZOCP dropped %s, peer not reachable" %frames[0])
+
+    def _send_peer(self, peer, *frames):
+        info = self._peers.get(peer)
+        if info is not None:
+            self._send(self._dealers[info['endpoint']], *frames)
+
+    def _event(self, type, peer, *frames):
+        name = self._peers[peer]['name']
+        self._outbox.send_multipart([type, peer.bytes, name.encode('utf-8')] + list(frames))
+
+    def _handle_command(self, frames):
+        command = frames.pop(0)
+        if command == b"STOP":
+            return False
+        if command == b"WHISPER":
+            self._send_peer(uuid.UUID(bytes=frames[0]), b"WHISPER", *frames[1:])
+        elif command == b"SHOUT":
+            group = frames[0].decode('utf-8')
+            for peer, info in list(self._peers.items()):
+                if group in info['groups']:
+                    self._send_peer(peer, b"SHOUT", *frames)
+        elif command in (b"JOIN", b"LEAVE"):
+            for peer in list(self._peers):
+                self._send_peer(peer, command, *frames)
+        return True
+
+    def _handle_peer_message(self, peer, frames):
+        command = frames.pop(0)
+        if command == b"HELLO":
+            self._handle_hello(peer, frames)
+            return
+        if peer not in self._peers:
+            # the peer expired, a new hello brings it back
+            return
+        self._peers[peer]['seen'] = time.time()
+        if command == b"WHISPER":
+            self._event(b"WHISPER", peer, *frames)
+        elif command == b"SHOUT":
+            self._event(b"SHOUT", peer, *frames)
+        elif command == b"JOIN":
+            with self._lock:
+                self._peers[peer]['groups'].add(frames[0].decode('utf-8'))
+            self._event(b"JOIN", peer, frames[0])
+        elif command == b"LEAVE":
+            with self._lock:
+                self._peers[peer]['groups'].discard(frames[0].decode('utf-8'))
+            self._event(b"LEAVE", peer, frames[0])
+        elif command == b"PEERS":
+            for endpoint in json.loads(frames[0].decode('utf-8')):
+                self._connect(endpoint)
+        elif command == b"BYE":
+            self._remove_peer(peer)
+
+    def _handle_hello(self, peer, frames):
+        endpoint, name, headers, groups = [f.decode('utf-8') for f in frames]
+        if peer in self._peers:
+            self._peers[peer]['seen'] = time.time()
+            return
+        with self._lock:
+            self._peers[peer] = {
+                'endpoint': endpoint, 'name': name,
+                'headers': json.loads(headers),
+                'groups': set(json.loads(groups)), 'seen': time.time()}
+        old = self._endpoint_peers.get(endpoint)
+        if old is not None and old != peer:
+            # restarted at the same endpoint
+            self._remove_peer(old)
+        self._endpoint_peers[endpoint] = peer
+        if endpoint in self._dealers:
+            # say hello again as the peer may not have known us yet
+            self._hello(self._dealers[endpoint])
+        else:
+            self._connect(endpoint)
+        # tell the peer about the others
+        known = [info['endpoint'] for p, info in self._peers.items() if p != peer]
+        self._send_peer(peer, b"PEERS", json.dumps(known))
+        self._event(b"ENTER", peer, headers.encode('utf-8'), endpoint.encode('utf-8'))
+        for group in sorted(self._peers[peer]['groups']):
+            self._event(b"JOIN", peer, group.encode('utf-8'))
+
+    def _remove_peer(self, peer):
+        info = self._peers.get(peer)
+        if info is None:
+            return
+        self._event(b"EXIT", peer)
+        with self._lock:
+            del self._peers[peer]
+        if self._endpoint_peers.get(info['endpoint']) == peer:
+            del self._endpoint_peers[info['endpoint']]
+        dealer = self._dealers.pop(info['endpoint'], None)
+        if dealer is not None:
+            dealer.close(linger=0)
+
+    def _ping(self):
+        now = time.time()
+        for peer, info in list(self._peers.items()):
+            if now - info['seen'] > self.expiry:
+                logger.debug("ZOCP peer %s expired" %info['name'])
+                self._remove_peer(peer)
+            else:
+                self._send_peer(peer, b"PING")
+        # keep saying hello to seeds which are not there (anymore)
+        for endpoint in self._seeds:
+            if endpoint not in self._endpoint_peers:
+                dealer = self._dealers.pop(endpoint, None)
+                if dealer is not None:
+                    dealer.close(linger=0)
+                self._connect(endpoint)
+
+class MemoryNetwork(object):
+    """
+    In-process network connecting MemoryTransports
+
+    Stands in for the network and Pyre in tests and simulations: peers
+    see each other enter as soon as they're started and messages are
+    put straight into the inbox of the receiver, in the order they
+    were sent. Whispers and shouts can be given a latency, a random
+    extra delay of up to jitter seconds, which reorders them, and a
+    chance to be lost. The random choices come from seed.
+
+    Delayed messages are delivered by a thread when they're due. With
+    realtime False they're delivered by calling advance instead, which
+    moves the clock of the network forward, so a simulation can be run
+    again with the same outcome.
+
+    The network has its own zmq context, allowing for many more sockets
+    than the default. Each node uses four sockets, so large simulations
+    may need a higher limit of open files.
+
+        network = MemoryNetwork()
+        node = ZOCP(transport=network.transport())
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, seed=None, realtime=True, max_sockets=65536):
+        self.ctx = zmq.Context()
+        self.ctx.set(zmq.MAX_SOCKETS, max_sockets)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.realtime = realtime
+        # seconds the network was advanced when not realtime
+        self.time = 0.0
+        self.dropped = 0
+        # peer id : started transport
+        self._transports = collections.OrderedDict()
+        self._lock = threading.RLock()
+        # heap of (due time, sequence, sender, receiver, frames)
+        self._delayed = []
+        self._sequence = itertools.count()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+    def transport(self):
+        """
+        Return a new transport on this network
+        """
+        return MemoryTransport(self)
+
+    def advance(self, seconds):
+        """
+        Move the clock forward and deliver the messages which are due,
+        when not realtime
+        """
+        with self._lock:
+            self.time += seconds
+            self._deliver_due(self.time)
+
+    def close(self):
+        """
+        Stop delivering delayed messages and terminate the context
+        """
+        with self._lock:
+            self._delayed = []
+            thread, self._thread = self._thread, None
+            self._wakeup.notify()
+        if thread is not None:
+            thread.join()
+        self.ctx.destroy(linger=0)
+
+    def _start(self, transport):
+        with self._lock:
+            others = list(self._transports.values())
+            self._transports[transport.get_uuid()] = transport
+            for other in others:
+                other._deliver(transport._event(b"ENTER", transport._headers_frame(), transport.address))
+                for group in transport.get_own_groups():
+                    other._deliver(transport._event(b"JOIN", group.encode('utf-8')))
+                transport._deliver(other._event(b"ENTER", other._headers_frame(), other.address))
+                for group in other.get_own_groups():
+                    transport._deliver(other._event(b"JOIN", group.encode('utf-8')))
+
+    def _stop(self, transport):
+        with self._lock:
+            if self._transports.pop(transport.get_uuid(), None) is None:
+                return
+            for other in self._transports.values():
+                other._deliver(transport._event(b"EXIT"))
+
+    def _peers(self, transport):
+        with self._lock:
+            return [other for peer, other in self._transports.items()
+                    if other is not transport]
+
+    def _broadcast(self, sender, frames):
+        # group changes are not delayed, like the enter events
+        with self._lock:
+            for other in self._peers(sender):
+                other._deliver(frames)
+
+    def _send(self, sender, receiver, frames):
+        with self._lock:
+            if self.loss and self.random.random() < self.loss:
+                self.dropped += 1
+                return
+            delay = self.latency
+            if self.jitter:
+                delay += self.random.random() * self.jitter
+            if not delay:
+                receiver._deliver(frames)
+                return
+            now = _clock() if self.realtime else self.time
+            heapq.heappush(self._delayed, (now + delay, next(self._sequence), sender, receiver, frames))
+            if not self.realtime:
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._wakeup.notify()
+
+    def _run(self):
+        with self._lock:
+            while self._thread is not None:
+                if not self._delayed:
+                    self._wakeup.wait()
+                    continue
+                wait = self._delayed[0][0] - _clock()
+                if wait > 0:
+                    self._wakeup.wait(wait)
+                    continue
+                self._deliver_due(_clock())
+
+    def _deliver_due(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            due, seq, sender, receiver, frames = heapq.heappop(self._delayed)
+            # pyre doesn't deliver messages of peers which left
+            if sender.get_uuid() in self._transports and receiver.get_uuid() in self._transports:
+                receiver._deliver(frames)
+
+class MemoryTransport(object):
+    """
+    Transport on a MemoryNetwork, implementing the part of the Pyre API
+    used by ZOCP
+    """
+    # signals between nodes in this process take the simulated network
+    local_delivery = False
+
+    def __init__(self, network):
+        self.network = network
+        self.ctx = network.ctx
+        self._uuid = uuid.uuid4()
+        self._name = self._uuid.hex[:6]
+        self._headers = {}
+        self._groups = set()
+        self._started = False
+        # text on Python 2 as well, like the endpoints of other transports
+        self.address = ("mem://%s" % self._uuid.hex).encode('ascii').decode('ascii')
+        addr = "inproc://zocp-memory-%s" % self._uuid.hex
+        # no high water mark, a blocking send would hold the network
+        self.inbox = self.ctx.socket(zmq.PAIR)
+        self.inbox.set_hwm(0)
+        self.inbox.bind(addr)
+        self._outbox = self.ctx.socket(zmq.PAIR)
+        self._outbox.set_hwm(0)
+        self._outbox.connect(addr)
+
+    def get_uuid(self):
+        return self._uuid
+
+    def get_name(self):
+        return self._name
+
+    def set_name(self, name):
+        self._name = name
+
+    def set_header(self, key, value):
+        self._headers[key] = value
+
+    def start(self):
+        self._started = True
+        self.network._start(self)
+
+    def stop(self):
+        self._started = False
+        self.network._stop(self)
+        self._outbox.close(linger=0)
+        self.inbox.close(linger=0)
+
+    def recv(self):
+        return self.inbox.recv_multipart()
+
+    def join(self, group):
+        self._groups.add(group)
+        if self._started:
+            self.network._broadcast(self, self._event(b"JOIN", group.encode('utf-8')))
+
+    def leave(self, group):
+        self._groups.discard(group)
+        if self._started:
+            self.network._broadcast(self, self._event(b"LEAVE", group.encode('utf-8')))
+
+    def whisper(self, peer, msg):
+        receiver = self.network._transports.get(peer)
+        if receiver is None or receiver is self:
+            return
+        self.network._send(self, receiver, self._event(b"WHISPER", msg))
+
+    def shout(self, group, msg):
+        frames = self._event(b"SHOUT", group.encode('utf-8'), msg)
+        for other in self.network._peers(self):
+            if group in other._groups:
+                self.network._send(self, other, frames)
+
+    def get_peers(self):
+        return [other.get_uuid() for other in self.network._peers(self)]
+
+    def get_peer_address(self, peer):
+        return self.network._transports[peer].address
+
+    def get_peer_header_value(self, peer, key):
+        return self.network._transports[peer]._headers.get(key)
+
+    def get_own_groups(self):
+        return list(self._groups)
+
+    def get_peer_groups(self):
+        groups = set()
+        for other in self.network._peers(self):
+            groups.update(other._groups)
+        return list(groups)
+
+    def _event(self, type, *frames):
+        return [type, self._uuid.bytes, self._name.encode('utf-8')] + [
+            f if isinstance(f, bytes) else f.encode('utf-8') for f in frames]
+
+    def _headers_frame(self):
+        return json.dumps(self._headers).encode('utf-8')
+
+    def _deliver(self, frames):
+        # called with the network lock held, senders may be on any thread
+        if self._started:
+            self._outbox.send_multipart(frames)
+
+class ZOCPRequestError(Exception):
+    """
+    Raised through the future of a request when the peer replied with an
+    error, or when the peer left before replying
+    """
+    pass
+
 class ZOCP(Pyre):
 
     def __init__(self, *args, **kwargs):
-        super(ZOCP, self).__init__(*args, **kwargs)
+        # transport replacing Pyre, see StaticTransport and MemoryTransport
+        self._transport = kwargs.pop('transport', None)
+        endpoint = kwargs.pop('endpoint', None)
+        peers = kwargs.pop('peers', ())
+        if self._transport is None and endpoint is not None:
+            self._transport = StaticTransport(endpoint, peers, ctx=kwargs.get('ctx'))
+        if self._transport is None:
+            super(ZOCP, self).__init__(*args, **kwargs)
+        else:
+            self.inbox = self._transport.inbox
         self.subscriptions = {}
         self.subscribers = {}
         self.set_header("X-ZOCP", "1")
+        self.set_header("X-ZOCP-PROTO", str(ZOCP_PROTOCOL))
         self.peers_capabilities = {} # peer id : capability data
         self.capability = kwargs.get('capability', {})
         self._cur_obj = self.capability
         self._cur_obj_keys = ()
+        # dotted path : (keys, parameter) of all our parameters
+        self._params = {}
+        self._index_params(self._params, self.capability, self.capability)
+        # peer id : {dotted path : (keys, parameter)}
+        self._peer_params = {}
+        # emitter pattern : set of (peer hex, receiver) subscribed to it
+        self._patterns = {}
+        # dotted path : set of subscribed patterns matching the path
+        self._pattern_paths = {}
+        # (emit peer, emitter) : list of our receivers
+        self._receivers = {}
+        self._value_store = None
+        # keep the capabilities of peers as raw messages until accessed
+        self.lazy_capabilities = False
+        # state of departed peers, restored when they enter again
+        self.departed_peers = PeerCache()
+        # incremented on every modification of our capability other than
+        # of values only
+        self._cap_version = 0
+        # peer id : version of the peer capability we last fetched
+        self._peer_versions = {}
+        # emit peer id : {emitter : [receivers]} we subscribed to, kept
+        # when the peer exits to subscribe again when it returns
+        self._intended = {}
+        # zones this node is in, no zones syncs with all peers
+        self._zones = set()
+        # peer id : zones the peer joined
+        self._peer_zones = {}
+        # peers not sharing a zone, their capability isn't fetched
+        self._unsynced = set()
+        # maximum number of nodes a signal is forwarded through
+        self.max_signal_hops = 16
+        # hops and origin time of the signal being handled
+        self._cur_hop = None
+        # hops : [number of signals, total seconds since first forwarded]
+        self._route_stats = {}
+        # emit peer id : time it exited
+        self._exit_times = {}
+        # index of the parameters of our peers for queries
+        self._query_index = ParamIndex()
+        # last published snapshot and the key paths modified since,
+        # by peer id or None for our own capability
+        self._snapshot = Snapshot(freeze(self.capability), FrozenDict(), 0)
+        self._dirty = {}
+        # snapshots are only published once someone asked for one
+        self._snapshots_used = False
         self._running = False
+        # method name : handler(data, peer, name, grp)
+        self._handlers = {}
+        # method name : [number of calls, total seconds spent]
+        self._method_stats = {}
+        # traffic and timings, see get_metrics
+        self._metrics = Metrics()
+        # seconds between publishing _stats, None doesn't publish
+        self._stats_interval = None
+        self._stats_due = None
+        for method in ('GET', 'SET', 'CALL', 'CALLS', 'SUB', 'UNSUB', 'REP', 'MOD', 'SIG', 'SIGS', 'VER', 'SUBS', 'UNSUBS'):
+            self.register_method(method, getattr(self, '_handle_' + method))
+        # default time in seconds to wait for a reply on a request
+        self.request_timeout = 10.0
+        self._request_ids = itertools.count(1)
+        # request id : (future, peer, method, deadline)
+        self._pending = {}
+        # peer id : ids of the GETs sent without id, which a peer of
+        # protocol 1 answers with a MOD in order
+        self._untagged = {}
+        # thread which last ran the ZOCP loop
+        self._loop_thread = None
+        # id of the request being handled, None if no reply is expected
+        self._cur_request = None
+        # name : (callable, threaded) of methods peers can call
+        self._calls = {}
+        # number of threads running threaded calls
+        self.call_workers = 4
+        self._executor = None
+        # callables to run on the thread running the ZOCP loop, other
+        # threads add to it and wake up the poller through a socket pair
+        self._soon = collections.deque()
+        self._wake_lock = threading.Lock()
+        wake_addr = "inproc://zocp-wake-%s" % uuid.uuid4().hex
+        ctx = getattr(self._transport, 'ctx', None) or zmq.Context.instance()
+        self._wake_recv = ctx.socket(zmq.PAIR)
+        self._wake_recv.bind(wake_addr)
+        self._wake_send = ctx.socket(zmq.PAIR)
+        self._wake_send.connect(wake_addr)
+        # executor running the on_* callbacks, None runs them inline
+        self._callback_executor = None
+        self._callback_per_emitter = False
+        self._callback_max_queue = 0
+        self._callback_lock = threading.Lock()
+        # ordering key : deque of (func, args) waiting to be run
+        self._callback_queues = {}
+        # ordering keys having a callback in the executor
+        self._callback_active = set()
+        self.callbacks_dropped = 0
         # We always join the ZOCP group
         self.join("ZOCP")
         self.poller = zmq.Poller()
         self.poller.register(self.inbox, zmq.POLLIN)
+        self.poller.register(self._wake_recv, zmq.POLLIN)
+        # epoll or kqueue object watching both sockets, see get_fd
+        self._fd_poller = None
+        # deliver signals to nodes in this process without sockets,
+        # unless the transport has to carry them
+        self.local_delivery = getattr(self._transport, 'local_delivery', True)
+        if self.local_delivery:
+            _local_nodes[self.get_uuid()] = self
 
     #########################################
     # Node methods. 
@@ -101,13 +1689,14 @@ class ZOCP(Pyre):
         Set node's capability, overwites previous
         """
         self.capability = cap
-        self._on_modified(data=cap)
+        self._mark_dirty(None, ())
+        self._on_modified(data=cap, keys=())
 
     def get_capability(self):
         """
-        Return node's capabilities
+        Return a copy of node's capabilities as plain dicts
         """
-        return self.capability
+        return plain_dict(self.capability)
 
     def set_node_name(self, name):
         """
@@ -130,21 +1719,21 @@ class ZOCP(Pyre):
         Set node's location, overwites previous
         """
         self.capability['_location'] = location
-        self._on_modified(data={'_location': location})
+        self._on_modified(data={'_location': location}, keys=())
 
     def set_node_orientation(self, orientation=[0,0,0]):
         """
         Set node's name, overwites previous
         """
         self.capability['_orientation'] = orientation
-        self._on_modified(data={'_orientation': orientation})
+        self._on_modified(data={'_orientation': orientation}, keys=())
 
     def set_node_scale(self, scale=[0,0,0]):
         """
         Set node's name, overwites previous
         """
         self.capability['_scale'] = scale
-        self._on_modified(data={'scale': scale})
+        self._on_modified(data={'scale': scale}, keys=())
 
     def set_node_matrix(self, matrix=[[1,0,0,0],
                                       [0,1,0,0],
@@ -154,7 +1743,7 @@ class ZOCP(Pyre):
         Set node's matrix, overwites previous
         """
         self.capability['_matrix'] = matrix
-        self._on_modified(data={'_matrix':matrix})
+        self._on_modified(data={'_matrix':matrix}, keys=())
 
     def set_object(self, name=None, type="Unknown"):
         """
@@ -163,6 +1752,8 @@ class ZOCP(Pyre):
         if name == None:
             self._cur_obj = self.capability
             self._cur_obj_keys = ()
+            return
+        self._mark_dirty(None, ('objects', name))
         if not self.capability.get('objects'):
             self.capability['objects'] = {name: {'type': type}}
         elif not self.capability['objects'].get(name):
@@ -173,13 +1764,16 @@ class ZOCP(Pyre):
         self._cur_obj_keys = ('objects', name)
 
     def _register_param(self, name, value, type_hint, access='r', min=None, max=None, step=None):
-        self._cur_obj[name] = {'value': value, 'typeHint': type_hint, 'access':access, 'subscribers': [] }
+        self._cur_obj[name] = Parameter(value=value, typeHint=type_hint, access=access, subscribers=OrderedSet())
         if min:
             self._cur_obj[name]['min'] = min
         if max:
             self._cur_obj[name]['max'] = max
         if step:
             self._cur_obj[name]['step'] = step
+        keys = self._cur_obj_keys + (name,)
+        self._params[".".join(keys)] = (keys, self._cur_obj[name])
+        self._match_patterns([".".join(keys)])
         self._on_modified(data={name: self._cur_obj[name]})
 
     def register_int(self, name, int, access='r', min=None, max=None, step=None):
@@ -296,38 +1890,334 @@ class ZOCP(Pyre):
         """
         self._register_param(name, vec4f, 'vec4f', access, min, max, step)
 
+    def register_method(self, method, handler):
+        """
+        Register a handler for a ZOCP method, replaces any previous handler
+
+        Arguments are:
+        * method: name of the method as used in the message, i.e. 'GET'
+        * handler: callable invoked as handler(data, peer, name, grp) for
+                   every message containing the method
+
+        This allows applications to extend the protocol without
+        overriding get_message.
+        """
+        self._handlers[method] = handler
+        self._method_stats.setdefault(method, [0, 0.0])
+
+    def unregister_method(self, method):
+        """
+        Remove the handler of a ZOCP method. Messages containing the
+        method are ignored afterwards.
+        """
+        self._handlers.pop(method, None)
+
+    def register_call(self, name, func, threaded=False):
+        """
+        Register a method peers can invoke using peer_call
+
+        Arguments are:
+        * name: the name peers use to call the method
+        * func: callable receiving the arguments of the call, its
+                return value is sent back to the caller
+        * threaded: if True the method runs in a worker pool of
+                    call_workers threads so long running calls don't
+                    block the ZOCP loop
+        """
+        self._calls[name] = (func, threaded)
+
+    def unregister_call(self, name):
+        """
+        Remove a method registered using register_call
+        """
+        self._calls.pop(name, None)
+
+    def set_callback_executor(self, executor, max_queue=100, per_emitter=False):
+        """
+        Run the on_peer_signaled, on_peer_modified and on_modified
+        callbacks in an executor instead of in the ZOCP loop
+
+        Arguments are:
+        * executor: a concurrent.futures.Executor, i.e. a
+                    ThreadPoolExecutor, or None to run callbacks inline
+                    again. The callbacks are methods of this node so the
+                    executor must run them in this process.
+        * max_queue: maximum number of callbacks waiting per peer, when
+                     exceeded the oldest waiting callback is dropped
+        * per_emitter: if True signals of different emitters of a peer
+                       may be handled concurrently
+
+        Callbacks of one peer (or emitter) are run one at a time in the
+        order they were received. Callbacks receive a copy of the data
+        as the ZOCP loop keeps updating its own state.
+        """
+        self._callback_executor = executor
+        self._callback_max_queue = max_queue
+        self._callback_per_emitter = per_emitter
+
+    def get_value_store(self):
+        """
+        Return the columnar store of numeric parameter values of this
+        node, see ValueStore. Requires NumPy.
+        """
+        if self._value_store is None:
+            self._value_store = ValueStore(self)
+        return self._value_store
+
+    def query(self, name=None, typeHint=None, access=None, type=None):
+        """
+        Return a list of (peer, path, parameter) of all parameters of
+        peers matching the given criteria
+
+        Arguments are:
+        * name: name of the parameter, i.e. 'location'
+        * typeHint: typeHint of the parameter, i.e. 'vec3f'
+        * access: access flags the parameter must have, i.e. 'w'
+        * type: type of the object the parameter belongs to
+        """
+        self._load_peers()
+        result = []
+        for peer, path in self._query_index.find(name, typeHint, access, type):
+            result.append((peer, path, self._peer_params[peer][path][1]))
+        return result
+
+    def snapshot(self):
+        """
+        Return a Snapshot of the capability of this node and those of
+        its peers
+
+        The snapshot is read-only and consistent, it is published by
+        the ZOCP loop after handling its events so other threads can
+        read it without locking. Unmodified parts are shared between
+        successive snapshots. The loop only publishes snapshots after
+        the first call, which waits for the loop to publish one.
+        """
+        if not self._snapshots_used:
+            self._snapshots_used = True
+            if self._in_loop():
+                self._update_snapshot()
+            else:
+                published = threading.Event()
+                self._call_soon(self._update_snapshot, published)
+                published.wait(self.request_timeout)
+        return self._snapshot
+
+    def set_zones(self, zones):
+        """
+        Set the zones of this node, replacing previous zones
+
+        A node in zones joins the group 'ZOCP/<zone>' of each zone and
+        only fetches the capabilities of peers sharing a zone with it,
+        which cuts the discovery traffic in large installations. A node
+        without zones fetches the capabilities of all peers.
+        """
+        zones = set(zones)
+        for zone in self._zones - zones:
+            self.leave(ZONE_PREFIX + zone)
+        for zone in zones - self._zones:
+            self.join(ZONE_PREFIX + zone)
+        self._zones = zones
+        for peer in list(self._unsynced):
+            if not zones or zones & self._peer_zones.get(peer, set()):
+                self._unsynced.discard(peer)
+                self._fetch_capability(peer)
+
+    def get_zones(self):
+        """
+        Return the set of zones of this node
+        """
+        return set(self._zones)
+
+    def get_routing_graph(self):
+        """
+        Return a RoutingGraph of the signal routes advertised by this
+        node and its peers
+        """
+        graph = RoutingGraph()
+        graph.add_capability(self.get_uuid().hex, self.capability)
+        for peer, capability in list(self.peers_capabilities.items()):
+            graph.add_capability(peer.hex, capability)
+        return graph
+
+    def get_route_stats(self):
+        """
+        Return statistics of forwarded signals received per hop count
+
+        Returns a dictionary of hops : {'count': n, 'time': seconds}
+        where time is the total time since the first node forwarded the
+        signals. This assumes the clocks of the nodes are synchronized.
+        """
+        return dict((hops, {'count': count, 'time': spent})
+                    for hops, (count, spent) in self._route_stats.items())
+
+    def get_method_stats(self):
+        """
+        Return dispatch statistics per method
+
+        Returns a dictionary of method name : {'count': n, 'time': seconds}
+        where time is the total time spent in the handler of the method.
+        """
+        return dict((method, {'count': count, 'time': spent})
+                    for method, (count, spent) in self._method_stats.items())
+
+    def get_metrics(self):
+        """
+        Return the traffic and timings of this node
+
+        Returns a dictionary of:
+        * totals: messages_in, bytes_in, messages_out and bytes_out
+        * methods: method name : the same counters. A message holding
+                   several methods counts for each of them.
+        * peers: peer id : the same counters
+        * emitters: emitter : number of signals sent to subscribers
+        * peer_emitters: peer id : {emitter : number of signals received}
+        * dispatch: histogram of the seconds spent handling a message
+        * callbacks: histogram of the seconds spent in the on_peer_signaled,
+                     on_peer_modified and on_modified callbacks
+
+        Histograms are dictionaries of count, time (total seconds),
+        max, p50, p99 and buckets, a list of [upper bound, count] of
+        the buckets holding durations. Signals delivered to nodes in
+        this process count as messages of 0 bytes.
+        """
+        return self._metrics.to_dict()
+
+    def set_stats_interval(self, interval):
+        """
+        Publish a summary of the metrics as the read-only '_stats' item
+        of our capability every interval seconds, None stops publishing
+
+        The summary holds the totals of get_metrics and the p50 and p99
+        of the dispatch and callback times. It's updated at this fixed
+        rate only, so publishing it doesn't cause traffic feeding back
+        into it.
+        """
+        self._stats_interval = interval
+        if interval is None:
+            self._stats_due = None
+            if self.capability.pop('_stats', None) is not None:
+                self._mark_dirty(None, ('_stats',))
+        else:
+            self._stats_due = _clock() + interval
+
     #########################################
     # Node methods to peers
     #########################################
-    def peer_get_capability(self, peer):
+    def peer_get_capability(self, peer, timeout=None):
         """
         Get the capabilities of peer
 
         Convenience method since it's the same a calling GET on a peer with no 
         data
         """
-        self.peer_get(peer, None)
+        return self.peer_get(peer, None, timeout)
 
-    def peer_get(self, peer, keys):
+    def peer_get_version(self, peer, timeout=None):
+        """
+        Get the version of the capability of peer
+
+        Returns a concurrent.futures.Future which resolves to a number
+        which changes whenever parameters or objects are added to or
+        removed from the capability of the peer, but not when only
+        their values change.
+        """
+        return self._request(peer, 'VER', None, timeout)
+
+    def peer_get(self, peer, keys, timeout=None):
         """
         Get items from peer
+
+        Returns a concurrent.futures.Future which resolves to the items
+        returned by the peer. The peer's capability in peers_capabilities
+        is updated before the future resolves. If timeout (seconds) is
+        None request_timeout is used.
         """
-        msg = json.dumps({'GET': keys})
-        self.whisper(peer, msg.encode('utf-8'))
+        return self._request(peer, 'GET', keys, timeout)
 
-    def peer_set(self, peer, data):
+    def peer_set(self, peer, data, timeout=None):
         """
         Set items on peer
+
+        Returns a concurrent.futures.Future which resolves when the peer
+        has applied the data.
         """
-        msg = json.dumps({'SET': data})
-        self.whisper(peer, msg.encode('utf-8'))
+        return self._request(peer, 'SET', data, timeout)
 
-    def peer_call(self, peer, method, *args):
+    def peer_call(self, peer, method, *args, **kwargs):
         """
         Call method on peer
+
+        Returns a concurrent.futures.Future which resolves to the return
+        value of the method. A timeout in seconds can be passed as
+        keyword argument.
         """
-        msg = json.dumps({'CALL': [method, args]})
-        self.whisper(peer, msg.encode('utf-8'))
+        timeout = kwargs.pop('timeout', None)
+        if kwargs:
+            raise TypeError("peer_call() got unexpected keyword arguments: %s"
+                            %", ".join(sorted(kwargs)))
+        return self._request(peer, 'CALL', [method, args], timeout)
+
+    def peer_call_many(self, peer, calls, timeout=None):
+        """
+        Call several methods on peer in one round trip
+
+        Arguments are:
+        * peer: id of the peer
+        * calls: list of (method, args) tuples, executed in order by
+                 the peer
+        * timeout: time in seconds to wait for the reply
+
+        Returns a concurrent.futures.Future which resolves to a list with
+        the return value of every call, or a ZOCPRequestError instance
+        for calls which failed.
+        """
+        return self._request(peer, 'CALLS', [[method, list(args)] for method, args in calls], timeout)
+
+    def _request(self, peer, method, data, timeout=None):
+        """
+        Send a request to peer and return a future for the reply
+
+        Every request is tagged with an id which the peer returns in its
+        REP message, so many requests can be outstanding per peer. The
+        future is resolved by the ZOCP loop, so don't block on it from
+        the thread running the loop. Use add_done_callback or wrap it
+        using asyncio.wrap_future instead. Can be called from any
+        thread, the request is then sent by the thread running the loop.
+
+        Peers of protocol 1 don't know request ids. A GET is sent to
+        them untagged and resolved by the next MOD of the peer, a SET
+        is resolved once sent and other requests fail.
+        """
+        if timeout is None:
+            timeout = self.request_timeout
+        request_id = next(self._request_ids)
+        future = Future()
+        deadline = _clock() + timeout if timeout else None
+        if self._peer_protocol(peer) >= 2:
+            self._pending[request_id] = (future, peer, method, deadline)
+            msg = encode_message({method: data, 'ID': request_id})
+        elif method == 'GET':
+            self._pending[request_id] = (future, peer, method, deadline)
+            self._untagged.setdefault(peer, collections.deque()).append(request_id)
+            msg = encode_message({method: data})
+        elif method == 'SET':
+            future.set_result(None)
+            msg = encode_message({method: data})
+        else:
+            future.set_exception(ZOCPRequestError("peer %s doesn't know %s requests" %(peer, method)))
+            return future
+        if self._in_loop():
+            self._send(peer, method, msg)
+        else:
+            self._call_soon(self._send, peer, method, msg)
+        return future
+
+    def _in_loop(self):
+        """
+        Return True if called from the thread running the ZOCP loop, or
+        when no thread ran it yet
+        """
+        return self._loop_thread is None or self._loop_thread is threading.current_thread()
 
     def signal_subscribe(self, recv_peer, receiver, emit_peer, emitter):
         """
@@ -341,31 +2231,47 @@ class ZOCP(Pyre):
         * emit_peer: id of the peer to subscribe to
         * emitter: capability name of the emitter on the peer to
                    subscribe to. If None, all capabilities will emit to
-                   the receiver
+                   the receiver. A glob pattern like
+                   'objects.Camera*.location' or 'objects.Cube.*'
+                   subscribes to all matching emitters, including ones
+                   registered later.
 
         A third node can instruct two nodes to subscribe to one another
         by specifying the ids of the peers. The subscription request
         is then sent to the emitter node which in turn forwards the
         subscribtion request to the receiver node.
         """
-        if recv_peer == self.get_uuid():
+        self.signal_subscribe_many([(recv_peer, receiver, emit_peer, emitter)])
+
+    def signal_subscribe_many(self, subscriptions):
+        """
+        Subscribe several receivers to emitters
+
+        Arguments are:
+        * subscriptions: list of (recv_peer, receiver, emit_peer, emitter)
+                         tuples, see signal_subscribe
+
+        The subscriptions to an emitting peer are sent in one message,
+        which the peer applies with a single modification of its
+        capability.
+        """
+        node_id = self.get_uuid()
+        for recv_peer, receiver, emit_peer, emitter in subscriptions:
+            if recv_peer != node_id:
+                continue
             # we are the receiver so register the emitter
             peer_subscriptions = {}
             if emit_peer in self.subscriptions:
                 peer_subscriptions = self.subscriptions[emit_peer]
-            if not emitter in peer_subscriptions:
-                peer_subscriptions[emitter] = [receiver]
-            elif not receiver in peer_subscriptions[emitter]:
-                peer_subscriptions[emitter].append(receiver)
+            peer_subscriptions.setdefault(emitter, OrderedSet()).add(receiver)
             self.subscriptions[emit_peer] = peer_subscriptions
+            self._receivers.clear()
+            self._intended.setdefault(emit_peer, {}).setdefault(emitter, OrderedSet()).add(receiver)
 
-            # check if the peer capability is known
-            if receiver is not None:
-                if receiver not in self.peers_capabilities:
-                    self.peer_get(recv_peer, {receiver: {}})
+            if receiver is not None and receiver not in self._params:
+                logger.warning("ZOCP SUB     : receiver %s is not in our capability" %receiver)
 
-        msg = json.dumps({'SUB': [emit_peer.hex, emitter, recv_peer.hex, receiver]})
-        self.whisper(emit_peer, msg.encode('utf-8'))
+        self._send_subscriptions('SUB', subscriptions)
 
     def signal_unsubscribe(self, recv_peer, receiver, emit_peer, emitter):
         """
@@ -385,36 +2291,178 @@ class ZOCP(Pyre):
         is then sent to the emitter node which in turn forwards the
         subscribtion request to the receiver node.
         """
-        if recv_peer == self.get_uuid():
+        self.signal_unsubscribe_many([(recv_peer, receiver, emit_peer, emitter)])
+
+    def signal_unsubscribe_many(self, subscriptions):
+        """
+        Unsubscribe several receivers from emitters
+
+        Arguments are:
+        * subscriptions: list of (recv_peer, receiver, emit_peer, emitter)
+                         tuples, see signal_unsubscribe
+        """
+        node_id = self.get_uuid()
+        for recv_peer, receiver, emit_peer, emitter in subscriptions:
+            if recv_peer != node_id:
+                continue
             # we are the receiver so unregister the emitter
+            intended = self._intended.get(emit_peer, {})
+            if receiver in intended.get(emitter, ()):
+                intended[emitter].discard(receiver)
+                if not intended[emitter]:
+                    intended.pop(emitter)
+                if not intended:
+                    self._intended.pop(emit_peer)
             if (emit_peer in self.subscriptions and
                     emitter in self.subscriptions[emit_peer] and
                     receiver in self.subscriptions[emit_peer][emitter]):
-                self.subscriptions[emit_peer][emitter].remove(receiver)
-                if not any(self.subscriptions[emit_peer][emitter]):
+                self.subscriptions[emit_peer][emitter].discard(receiver)
+                # receivers may be None, so test for emptiness not truth
+                if not self.subscriptions[emit_peer][emitter]:
                     self.subscriptions[emit_peer].pop(emitter)
-                if not any(self.subscriptions[emit_peer]):
+                if not self.subscriptions[emit_peer]:
                     self.subscriptions.pop(emit_peer)
+                self._receivers.clear()
+
+        self._send_subscriptions('UNSUB', subscriptions)
+
+    def _send_subscriptions(self, method, subscriptions):
+        """
+        Send SUB or UNSUB requests to the emitting peers, one message per
+        peer
+        """
+        requests = collections.OrderedDict()
+        for recv_peer, receiver, emit_peer, emitter in subscriptions:
+            requests.setdefault(emit_peer, []).append(
+                    [emit_peer.hex, emitter, recv_peer.hex, receiver])
+        for emit_peer, data in requests.items():
+            if emit_peer == self.get_uuid():
+                # subscribing to our own emitter
+                self._apply_subscriptions(method, data, emit_peer, self.get_name())
+            else:
+                self._whisper_subscriptions(emit_peer, method, data)
 
-        msg = json.dumps({'UNSUB': [emit_peer.hex, emitter, recv_peer.hex, receiver]})
-        self.whisper(emit_peer, msg.encode('utf-8'))
+    def _whisper_subscriptions(self, peer, method, data):
+        # a single request is sent as SUB or UNSUB, which all peers know
+        if len(data) == 1 or self._peer_protocol(peer) < 2:
+            for sub in data:
+                self._send(peer, method, encode_message({method: sub}))
+        else:
+            method += 'S'
+            self._send(peer, method, encode_message({method: data}))
+
+    def _peer_protocol(self, peer):
+        """
+        Return the protocol version a peer advertises, 1 for peers
+        which don't
+        """
+        try:
+            version = self.get_peer_header_value(peer, "X-ZOCP-PROTO")
+        except KeyError:
+            version = None
+        try:
+            return int(version)
+        except (TypeError, ValueError):
+            return 1
 
     def emit_signal(self, emitter, data):
         """
         Update the value of the emitter and signal all subscribed receivers
 
         Arguments are:
-        * emitter: name of the emitting capability
+        * emitter: name of the emitting capability, parameters of
+                   objects are named by their dotted path, i.e.
+                   'objects.Cube.location'
         * data: value
         """
-        self.capability[emitter]['value'] = data
-        msg = json.dumps({'SIG': [emitter, data]})
+        self._emit([(emitter, data)])
+
+    def emit_signals(self, signals):
+        """
+        Update the values of several emitters and signal all subscribed
+        receivers, using a single message per subscriber
+
+        Arguments are:
+        * signals: list of (emitter, value) tuples
+        """
+        self._emit(signals)
 
-        for subscriber in self.subscribers:
-            if (None in self.subscribers[subscriber] or
-                    emitter in self.subscribers[subscriber]):
-                self.whisper(subscriber, msg.encode('utf-8'))
+    def _emit(self, signals, hops=0, origin=None):
+        """
+        Update the values of emitters and signal the subscribers, each
+        distinct message is encoded once. Signals forwarded from other
+        nodes carry the number of hops and the time the first node
+        forwarded them.
+        """
+        self._set_values(signals)
 
+        # indices of the signals : encoded message
+        messages = {}
+        for subscriber, subscriptions in self.subscribers.items():
+            indices = tuple(i for i, (emitter, value) in enumerate(signals)
+                            if self._is_subscribed(subscriptions, emitter))
+            if not indices:
+                continue
+            sigs = [signals[i] for i in indices]
+            if not self._throttle(subscriber, sigs):
+                self._send_signals(subscriber, sigs, hops, origin, messages, indices)
+
+    def _set_values(self, signals):
+        """
+        Update the values of our parameters from a list of
+        (emitter, value)
+        """
+        for emitter, value in signals:
+            keys, param = self._get_param(emitter)
+            param['value'] = value
+            self._mark_dirty(None, keys, structural=False)
+
+    def _throttle(self, subscriber, signals):
+        """
+        Returns True if the signals to a subscriber are held back.
+        Subclasses can override this to limit the rate of signals.
+        """
+        return False
+
+    def _send_signals(self, subscriber, signals, hops=0, origin=None, cache=None, key=None):
+        """
+        Send a list of (emitter, value) to a subscriber, cache is a dict
+        of key : encoded message to share the encoding between
+        subscribers
+        """
+        method = 'SIG' if len(signals) == 1 else 'SIGS'
+        self._metrics.signals_out(signals)
+        if subscriber == self.get_uuid():
+            # signals to ourselves never arrive through the transport
+            node = self
+        else:
+            node = _local_nodes.get(subscriber) if self.local_delivery else None
+        if node is not None:
+            self._metrics.message_out(subscriber, method, 0)
+            # the subscriber runs in this process, possibly in
+            # another thread, so hand the signals to its loop
+            sigs = [[emitter, _copy_value(value)] for emitter, value in signals]
+            node._call_soon(node._receive_local, sigs, self.get_uuid(),
+                            self.get_name(), [hops, origin] if hops else None)
+            return
+        if self._peer_protocol(subscriber) < 2:
+            # older peers know neither SIGS nor the HOP of forwarded signals
+            for emitter, value in signals:
+                self._send(subscriber, 'SIG', encode_message({'SIG': [emitter, value]}))
+            return
+        msg = cache.get(key) if cache is not None else None
+        if msg is None:
+            if len(signals) == 1:
+                emitter, value = signals[0]
+                msg = {'SIG': [emitter, value]}
+            else:
+                msg = {'SIGS': [list(signal) for signal in signals]}
+            if hops:
+                msg['HOP'] = [hops, origin]
+            msg = encode_message(msg)
+            if cache is not None:
+                cache[key] = msg
+        self._send(subscriber, method, msg)
 
     #########################################
     # ZRE event methods. These can be overwritten
@@ -458,6 +2506,13 @@ class ZOCP(Pyre):
         logger.debug("ZOCP PEER MODIFIED: %s modified %s" %(name, data))
 
     def on_peer_replied(self, peer, name, data, *args, **kwargs):
+        """
+        Called when a peer replies to a request of this node.
+
+        peer: id of peer that replied
+        name: name of peer that replied
+        data: the reply, formatted as [request id, result, error]
+        """
         logger.debug("ZOCP PEER REPLIED : %s modified %s" %(name, data))
 
     def on_peer_subscribed(self, peer, name, data, *args, **kwargs):
@@ -496,6 +2551,16 @@ class ZOCP(Pyre):
         else:
             logger.debug("ZOCP PEER UNSUBSCRIBED: %s unsubscribed %s from %s" %(name, receiver, emitter))
 
+    def on_peer_resubscribed(self, peer, name, data, *args, **kwargs):
+        """
+        Called when the subscriptions to a returning peer are restored.
+
+        peer: id of the emitting peer
+        name: name of the emitting peer
+        data: seconds since the peer exited
+        """
+        logger.debug("ZOCP PEER RESUBSCRIBED: %s after %.3fs" %(name, data))
+
     def on_peer_signaled(self, peer, name, data, *args, **kwargs):
         """
         Called when a peer signals that some of its data is modified.
@@ -546,14 +2611,28 @@ class ZOCP(Pyre):
             #    logger.debug("Node is not a ZOCP node")
             #    return
 
+            state = self.departed_peers.pop(peer)
             if not peer in self.peers_capabilities.keys():
                 self.peers_capabilities.update({peer: {}})
+                self._mark_dirty(peer, ())
 
-            self.peer_get_capability(peer)
+            if state is None:
+                if self._zones:
+                    # fetched when the peer joins one of our zones
+                    self._unsynced.add(peer)
+                else:
+                    self._fetch_capability(peer)
             self.on_peer_enter(peer, name, msg)
+            if state is not None:
+                self._restore_peer(peer, name, state)
+            if peer in self._intended:
+                self._resubscribe(peer, name)
             return
 
         if type == "EXIT":
+            self._remember_peer(peer)
+            if peer in self._intended:
+                self._exit_times[peer] = _clock()
             if peer in self.subscribers:
                 self.subscribers.pop(peer)
             if peer in self.subscriptions:
@@ -561,10 +2640,26 @@ class ZOCP(Pyre):
             self.on_peer_exit(peer, name, msg)
             if peer in self.peers_capabilities:
                 self.peers_capabilities.pop(peer)
+                self._mark_dirty(peer, ())
+            self._peer_params.pop(peer, None)
+            self._peer_zones.pop(peer, None)
+            self._unsynced.discard(peer)
+            self._query_index.remove_peer(peer)
+            self._metrics.remove_peer(peer)
+            self._receivers.clear()
+            self._untagged.pop(peer, None)
+            self._fail_requests(peer, "peer %s exited" %name)
             return
 
         if type == "JOIN":
             grp = msg.pop(0)
+            zone = grp.decode('utf-8')
+            if zone.startswith(ZONE_PREFIX):
+                zone = zone[len(ZONE_PREFIX):]
+                self._peer_zones.setdefault(peer, set()).add(zone)
+                if zone in self._zones and peer in self._unsynced:
+                    self._unsynced.discard(peer)
+                    self._fetch_capability(peer)
             self.on_peer_join(peer, name, grp, msg)
             return
 
@@ -574,6 +2669,9 @@ class ZOCP(Pyre):
             #if peer in self.subscriptions:
             #    self.subscriptions.pop(peer)
             grp = msg.pop(0)
+            zone = grp.decode('utf-8')
+            if zone.startswith(ZONE_PREFIX):
+                self._peer_zones.get(peer, set()).discard(zone[len(ZONE_PREFIX):])
             self.on_peer_leave(peer, name, grp, msg)
             return
 
@@ -587,202 +2685,933 @@ class ZOCP(Pyre):
         else:
             return
 
+        start = _clock()
+        size = len(msg[0])
+        if self.lazy_capabilities and _LAZY_MOD.match(msg[0]):
+            # the MOD is decoded when the capability is accessed
+            data = LazyCapability()
+            data.add_message(msg[0])
+            self._metrics.message_in(peer, ('MOD',), size)
+            self._dispatch({'MOD': data}, peer, name, grp)
+            self._metrics.dispatch.observe(_clock() - start)
+            return
+
         try:
             msg = json.loads(msg.pop(0).decode('utf-8'))
         except Exception as e:
             logger.error("ERROR: %s in %s, type %s" %(e, msg, type))
         else:
-            for method in msg.keys():
-                if method   == 'GET':
-                    self._handle_GET(msg[method], peer, name, grp)
-                elif method == 'SET':
-                    self._handle_SET(msg[method], peer, name, grp)
-                elif method == 'CALL':
-                    self._handle_CALL(msg[method], peer, name, grp)
-                elif method == 'SUB':
-                    self._handle_SUB(msg[method], peer, name, grp)
-                elif method == 'UNSUB':
-                    self._handle_UNSUB(msg[method], peer, name, grp)
-                elif method == 'REP':
-                    self._handle_REP(msg[method], peer, name, grp)
-                elif method == 'MOD':
-                    self._handle_MOD(msg[method], peer, name, grp)
-                elif method == 'SIG':
-                    self._handle_SIG(msg[method], peer, name, grp)
+            if not isinstance(msg, dict):
+                logger.error("ERROR: invalid message %s from %s" %(msg, name))
+                return
+            self._metrics.message_in(peer, [method for method in msg
+                                            if method not in ('ID', 'HOP')], size)
+            self._dispatch(msg, peer, name, grp)
+            self._metrics.dispatch.observe(_clock() - start)
+
+    def _dispatch(self, msg, peer, name, grp):
+        # a request expecting a reply carries an id
+        request_id = msg.pop('ID', None)
+        # forwarded signals carry their hops and origin time
+        self._cur_hop = msg.pop('HOP', None)
+        for method, data in msg.items():
+            handler = self._handlers.get(method)
+            if handler is None:
+                handler = self._get_legacy_handler(method)
+                if handler is None:
+                    logger.warning("ZOCP: no handler for method %s from %s" %(method, name))
+                    if request_id is not None:
+                        self._reply(peer, request_id, error="no method %s" %method)
+                    continue
+            start = _clock()
+            if request_id is None:
+                handler(data, peer, name, grp)
+            else:
+                self._cur_request = request_id
+                try:
+                    result = handler(data, peer, name, grp)
+                except Exception as e:
+                    logger.exception("ZOCP: error handling %s from %s" %(method, name))
+                    self._reply(peer, request_id, error=str(e))
                 else:
-                    try:
-                        func = getattr(self, 'handle_'+method)
-                        func(msg[method])
-                    except:
-                        raise Exception('No %s method on resource: %s' %(method,object))
+                    if isinstance(result, Future):
+                        # the handler replies when it is done
+                        result.add_done_callback(lambda f, peer=peer, request_id=request_id:
+                                self._call_soon(self._reply_future, peer, request_id, f))
+                    else:
+                        self._reply(peer, request_id, result)
+                finally:
+                    self._cur_request = None
+            stats = self._method_stats[method]
+            stats[0] += 1
+            stats[1] += _clock() - start
+
+    def _send(self, peer, method, msg):
+        """
+        Whisper the encoded message of method to peer
+        """
+        self._metrics.message_out(peer, method, len(msg))
+        self.whisper(peer, msg)
+
+    def _reply(self, peer, request_id, result=None, error=None):
+        if error is None:
+            msg = encode_message({'REP': [request_id, result]})
+        else:
+            msg = encode_message({'REP': [request_id, None, error]})
+        self._send(peer, 'REP', msg)
+
+    def _reply_future(self, peer, request_id, future):
+        error = future.exception()
+        if error is None:
+            self._reply(peer, request_id, future.result())
+        else:
+            self._reply(peer, request_id, error=str(error))
+
+    def _call_soon(self, func, *args):
+        """
+        Run func(*args) on the thread running the ZOCP loop. Can be
+        called from any thread.
+        """
+        self._soon.append((func, args))
+        with self._wake_lock:
+            try:
+                self._wake_send.send(b'', zmq.NOBLOCK)
+            except zmq.Again:
+                # plenty of wake ups pending already
+                pass
+
+    def _run_soon(self):
+        while True:
+            try:
+                self._wake_recv.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+        while self._soon:
+            func, args = self._soon.popleft()
+            func(*args)
+
+    def _run_callback(self, key, func, *args):
+        """
+        Run a user callback, in the callback executor if set. Callbacks
+        with the same key are run in order.
+        """
+        if self._callback_executor is None:
+            self._time_callback(func, *args)
+            return
+        # only the payload is mutable, peer ids and names are shared
+        args = tuple(_copy_value(arg) for arg in args)
+        with self._callback_lock:
+            queue = self._callback_queues.get(key)
+            if queue is None:
+                queue = self._callback_queues[key] = collections.deque()
+            if self._callback_max_queue and len(queue) >= self._callback_max_queue:
+                queue.popleft()
+                self.callbacks_dropped += 1
+                logger.warning("ZOCP: callback queue of %s full, dropped oldest" %(key,))
+            queue.append((func, args))
+            if key in self._callback_active:
+                return
+            self._callback_active.add(key)
+        self._next_callback(key)
+
+    def _time_callback(self, func, *args):
+        start = _clock()
+        try:
+            return func(*args)
+        finally:
+            self._metrics.callback_time(_clock() - start)
+
+    def _next_callback(self, key, future=None):
+        if future is not None and future.exception() is not None:
+            logger.error("ZOCP: callback failed: %s" %future.exception())
+        with self._callback_lock:
+            queue = self._callback_queues.get(key)
+            if not queue:
+                self._callback_queues.pop(key, None)
+                self._callback_active.discard(key)
+                return
+            func, args = queue.popleft()
+        try:
+            future = self._callback_executor.submit(self._time_callback, func, *args)
+        except RuntimeError:
+            # executor has been shut down
+            with self._callback_lock:
+                self._callback_queues.pop(key, None)
+                self._callback_active.discard(key)
+            return
+        future.add_done_callback(lambda f, key=key: self._next_callback(key, f))
+
+    def _get_param(self, path):
+        """
+        Return (keys, parameter) of one of our parameters by its dotted
+        path, raises a KeyError if it doesn't exist
+        """
+        entry = self._params.get(path)
+        if entry is None:
+            # parameters added to the capability without registering
+            entry = ((path,), self.capability[path])
+            self._params[path] = entry
+        return entry
+
+    def _index_params(self, index, tree, data, keys=()):
+        """
+        Add the parameters in tree touched by data to the path index,
+        returns the paths of the parameters
+        """
+        paths = []
+        for param_keys, param in dict_walk_params(tree, data, keys):
+            path = ".".join(param_keys)
+            index[path] = (param_keys, param)
+            paths.append(path)
+        return paths
+
+    def _reindex_params(self, keys):
+        """
+        Rebuild the path index of our parameters of the object at keys,
+        i.e. after it was modified in place
+        """
+        keys = tuple(keys)
+        for path, (param_keys, param) in list(self._params.items()):
+            if tuple(param_keys[:len(keys)]) == keys:
+                del self._params[path]
+                self._pattern_paths.pop(path, None)
+        node = dict_get(self.capability, keys)
+        self._match_patterns(self._index_params(self._params, node, node, keys))
+
+    def _match_patterns(self, paths):
+        """
+        Match newly registered parameters against the subscribed
+        patterns
+        """
+        for pattern, subscribers in self._patterns.items():
+            regex = compile_pattern(pattern)
+            for path in paths:
+                if regex.match(path):
+                    self._pattern_paths.setdefault(path, set()).add(pattern)
+                    param_subscribers(self._params[path][1]).update(subscribers)
+
+    def _is_subscribed(self, subscriptions, path):
+        """
+        Returns True if the subscriptions of a peer (emitter : receivers)
+        include the parameter at path
+        """
+        if None in subscriptions or path in subscriptions:
+            return True
+        patterns = self._pattern_paths.get(path)
+        return patterns is not None and any(pattern in subscriptions for pattern in patterns)
+
+    def _get_receivers(self, peer, emitter):
+        """
+        Return the list of our receivers subscribed to an emitter of a
+        peer, including subscriptions through patterns
+        """
+        key = (peer, emitter)
+        receivers = self._receivers.get(key)
+        if receivers is None:
+            subscription = self.subscriptions.get(peer, {})
+            receivers = OrderedSet(subscription.get(emitter, ()))
+            for pattern, pattern_receivers in subscription.items():
+                if pattern != emitter and is_pattern(pattern) and compile_pattern(pattern).match(emitter):
+                    receivers |= pattern_receivers
+            self._receivers[key] = receivers
+        return receivers
+
+    def _subscribers_modified(self, params):
+        """
+        Send one modification of the subscribers of a list of
+        (keys, parameter)
+        """
+        data = {}
+        for keys, param in params:
+            node = data
+            for key in keys[:-1]:
+                node = node.setdefault(key, {})
+            node[keys[-1]] = {'subscribers': param['subscribers']}
+        if data:
+            self._on_modified(data=data, keys=())
+
+    def _mark_dirty(self, peer, keys, structural=True):
+        # keys is the path of a modified part of the capability of the
+        # peer, our own if peer is None, for the next snapshot. Changes
+        # of values only don't change the version of our capability.
+        self._dirty.setdefault(peer, set()).add(tuple(keys))
+        # the published _stats aren't part of the version either
+        if peer is None and structural and tuple(keys[:1]) != ('_stats',):
+            self._cap_version += 1
+
+    def _update_snapshot(self, published=None):
+        if self._dirty:
+            self._publish_snapshot()
+        if published is not None:
+            published.set()
+
+    def _publish_snapshot(self):
+        dirty, self._dirty = self._dirty, {}
+        capability, peers, version = self._snapshot
+        if None in dirty:
+            capability = _refreeze(capability, self.capability, dirty.pop(None))
+        if dirty:
+            peers = dict(peers)
+            for peer, paths in dirty.items():
+                peer_cap = self.peers_capabilities.get(peer)
+                if isinstance(peer_cap, LazyCapability) and not peer_cap.is_loaded():
+                    # added to a snapshot once it is loaded
+                    self._dirty.setdefault(peer, set()).update(paths)
+                    continue
+                if peer_cap is not None:
+                    peers[peer] = _refreeze(peers.get(peer), peer_cap, paths)
+                else:
+                    peers.pop(peer, None)
+            peers = FrozenDict(peers)
+        # a single assignment, readers see either snapshot
+        self._snapshot = Snapshot(capability, peers, version + 1)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.call_workers)
+        return self._executor
+
+    def _fail_requests(self, peer, reason):
+        # fail all requests still waiting for a reply from peer
+        for request_id, (future, req_peer, method, deadline) in list(self._pending.items()):
+            if req_peer == peer:
+                self._pending.pop(request_id, None)
+                future.set_exception(ZOCPRequestError(reason))
+
+    def _expire_requests(self):
+        now = _clock()
+        for request_id, (future, peer, method, deadline) in list(self._pending.items()):
+            if deadline is not None and deadline <= now:
+                self._pending.pop(request_id, None)
+                future.set_exception(TimeoutError("%s request %s to %s timed out" %(method, request_id, peer)))
+
+    def _get_legacy_handler(self, method):
+        # Subclasses used to extend the protocol by implementing
+        # handle_<METHOD>(data). Register these on first use so
+        # subsequent lookups go through the registry.
+        func = getattr(self, 'handle_' + method, None)
+        if func is None:
+            return None
+        handler = lambda data, peer, name, grp: func(data)
+        self.register_method(method, handler)
+        return handler
 
     def _handle_GET(self, data, peer, name, grp=None):
         """
         If data is empty just return the complete capabilities object
         else fetch every item requested and return them
+
+        The items are returned in a REP if the request carries an id,
+        otherwise they are sent as a MOD. The complete capabilities
+        object is preceded by a VER message holding its version, for
+        peers of protocol 2 on.
         """
         if not data:
-            data = {'MOD': self.get_capability()}
-            self.whisper(peer, json.dumps(data).encode('utf-8'))
-            return
+            ret = self.capability
+            if self._peer_protocol(peer) >= 2:
+                self._send(peer, 'VER', encode_message({'VER': self._cap_version}))
         else:
-            # first is the object to retrieve from
-            # second is the items list of items to retrieve
             ret = {}
             for get_item in data:
                 ret[get_item] = self.capability.get(get_item)
-            self.peer_set(peer, data)
-            self.whisper(peer, json.dumps({ 'MOD' :ret}).encode('utf-8'))
+        if self._cur_request is None:
+            self._send(peer, 'MOD', encode_message({ 'MOD' :ret}))
+        return ret
+
+    def _handle_VER(self, data, peer, name, grp):
+        """
+        Return the version of our capability if requested, otherwise
+        data is the version of the capability the peer sends next
+        """
+        if self._cur_request is None:
+            self._peer_versions[peer] = data
+            return
+        return self._cap_version
 
     def _handle_SET(self, data, peer, name, grp):
-        self.capability = dict_merge(self.capability, data)
-        self._on_modified(data, peer, name)
+        """
+        Merge data into our capability and inform subscribers of the
+        effective changes, returns the changes
+        """
+        if isinstance(data, dict) and '_stats' in data:
+            logger.warning("ZOCP SET     : %s tried to set the read-only _stats" %name)
+            data = dict((key, value) for key, value in data.items() if key != '_stats')
+        diff = dict_merge_diff(self.capability, data)
+        if diff:
+            self._match_patterns(self._index_params(self._params, self.capability, diff))
+            self._on_modified(diff, peer, name, keys=())
+        return diff
 
     def _handle_CALL(self, data, peer, name, grp):
-        return
+        [method, args] = data
+        call = self._calls.get(method)
+        if call is None:
+            logger.warning("ZOCP CALL    : %s called unknown method %s" %(name, method))
+            if self._cur_request is not None:
+                raise ZOCPRequestError("no method %s" %method)
+            return
+        func, threaded = call
+        if threaded:
+            future = self._get_executor().submit(func, *args)
+            if self._cur_request is None:
+                future.add_done_callback(lambda f, method=method: self._log_call_error(method, f))
+            return future
+        if self._cur_request is not None:
+            return func(*args)
+        try:
+            func(*args)
+        except Exception:
+            logger.exception("ZOCP CALL    : %s failed" %method)
+
+    def _log_call_error(self, method, future):
+        if future.exception() is not None:
+            logger.error("ZOCP CALL    : %s failed: %s" %(method, future.exception()))
+
+    def _handle_CALLS(self, data, peer, name, grp):
+        calls = []
+        threaded = False
+        for method, args in data:
+            call = self._calls.get(method, (None, False))
+            calls.append((method, call[0], args))
+            threaded = threaded or call[1]
+        if threaded:
+            # run the whole batch in the pool to keep the calls in order
+            return self._get_executor().submit(self._run_calls, calls)
+        return self._run_calls(calls)
+
+    def _run_calls(self, calls):
+        results = []
+        for method, func, args in calls:
+            if func is None:
+                results.append([None, "no method %s" %method])
+                continue
+            try:
+                results.append([func(*args), None])
+            except Exception as e:
+                logger.exception("ZOCP CALLS   : %s failed" %method)
+                results.append([None, str(e)])
+        return results
 
     def _handle_SUB(self, data, peer, name, grp):
-        [emit_peer, emitter, recv_peer, receiver] = data
+        self._apply_subscriptions('SUB', [data], peer, name)
 
-        node_id = self.get_uuid()
-        recv_peer = uuid.UUID(recv_peer)
-        emit_peer = uuid.UUID(emit_peer)
-        if emit_peer != node_id and recv_peer != node_id:
-            # subscription requests are always initially send to the
-            # emitter peer. Recv_peer can only be matched to our id if
-            # a subscription to a receiver is done by the emitter.
-            logger.warning("ZOCP SUB     : invalid subscription request: %s" % data)
-            return
+    def _handle_SUBS(self, data, peer, name, grp):
+        self._apply_subscriptions('SUB', data, peer, name)
 
-        if recv_peer != peer:
-            # check if this should be forwarded (third party subscription request)
-            logger.debug("ZOCP SUB     : forwarding subscription request: %s" % data)
-            self.signal_subscribe(emit_peer, emitter, recv_peer, receiver)
-            return
+    def _handle_UNSUB(self, data, peer, name, grp):
+        self._apply_subscriptions('UNSUB', [data], peer, name)
 
-        if emitter is not None:
+    def _handle_UNSUBS(self, data, peer, name, grp):
+        self._apply_subscriptions('UNSUB', data, peer, name)
+
+    def _apply_subscriptions(self, method, data, peer, name):
+        """
+        Apply a list of SUB or UNSUB requests from a peer, followed by
+        a single modification of the subscribers of our parameters
+        """
+        node_id = self.get_uuid()
+        # dotted path : (keys, parameter) with modified subscribers
+        modified = collections.OrderedDict()
+        # requests we are the receiver of, forwarded by the emitter
+        own = []
+        # receiving peer : requests of third parties to forward to it
+        forward = collections.OrderedDict()
+        for request in data:
+            [emit_peer, emitter, recv_peer, receiver] = request
+            recv_peer = uuid.UUID(recv_peer)
+            emit_peer = uuid.UUID(emit_peer)
+            if emit_peer != node_id and recv_peer != node_id:
+                # subscription requests are always initially send to the
+                # emitter peer. Recv_peer can only be matched to our id if
+                # a subscription to a receiver is done by the emitter.
+                logger.warning("ZOCP %-6s : invalid subscription request: %s" %(method, request))
+                continue
+
+            if recv_peer != peer:
+                # third party subscription request, the emitter forwards
+                # it to the receiver which then subscribes itself
+                if recv_peer == node_id:
+                    own.append((recv_peer, receiver, emit_peer, emitter))
+                else:
+                    logger.debug("ZOCP %-6s : forwarding subscription request: %s" %(method, request))
+                    forward.setdefault(recv_peer, []).append(request)
+                continue
+
+            if method == 'SUB':
+                params = self._add_subscriber(recv_peer, receiver, emitter)
+                self.on_peer_subscribed(recv_peer, name, request)
+            else:
+                params, removed = self._remove_subscriber(recv_peer, receiver, emitter)
+                if removed:
+                    self.on_peer_unsubscribed(peer, name, request)
+            for keys, param in params:
+                modified[".".join(keys)] = (keys, param)
+
+        for recv_peer, requests in forward.items():
+            self._whisper_subscriptions(recv_peer, method, requests)
+        if own:
+            if method == 'SUB':
+                self.signal_subscribe_many(own)
+            else:
+                self.signal_unsubscribe_many(own)
+        self._subscribers_modified(list(modified.values()))
+
+    def _add_subscriber(self, recv_peer, receiver, emitter):
+        """
+        Subscribe a receiver of a peer to our emitter, returns a list of
+        (keys, parameter) of which the subscribers changed
+        """
+        subscriber = (recv_peer.hex, receiver)
+        modified = []
+        if is_pattern(emitter):
+            # update subscribers of all matching parameters
+            subscribers = self._patterns.get(emitter)
+            if subscribers is None:
+                subscribers = self._patterns[emitter] = set()
+                regex = compile_pattern(emitter)
+                for path in self._params:
+                    if regex.match(path):
+                        self._pattern_paths.setdefault(path, set()).add(emitter)
+            subscribers.add(subscriber)
+            for path, patterns in self._pattern_paths.items():
+                if emitter in patterns:
+                    keys, param = self._params[path]
+                    subscribers = param_subscribers(param)
+                    if subscriber not in subscribers:
+                        subscribers.add(subscriber)
+                        modified.append((keys, param))
+
+        elif emitter is not None:
             # update subscribers in capability tree
-            subscriber = (recv_peer.hex, receiver)
-            subscribers = self.capability[emitter]["subscribers"]
+            keys, param = self._get_param(emitter)
+            subscribers = param_subscribers(param)
             if subscriber not in subscribers:
-                subscribers.append(subscriber)
-                self._on_modified(data={emitter: {"subscribers": subscribers}})
+                subscribers.add(subscriber)
+                modified.append((keys, param))
 
         peer_subscribers = {}
         if recv_peer in self.subscribers:
             peer_subscribers = self.subscribers[recv_peer]
-        if not emitter in peer_subscribers:
-            peer_subscribers[emitter] = [receiver]
-        elif not receiver in peer_subscribers[emitter]:
-            peer_subscribers[emitter].append(receiver)
+        peer_subscribers.setdefault(emitter, OrderedSet()).add(receiver)
         self.subscribers[recv_peer] = peer_subscribers
-
-        self.on_peer_subscribed(recv_peer, name, data)
-        return
-
-    def _handle_UNSUB(self, data, peer, name, grp):
-        [emit_peer, emitter, recv_peer, receiver] = data
-
-        node_id = self.get_uuid()
-        recv_peer = uuid.UUID(recv_peer)
-        emit_peer = uuid.UUID(emit_peer)
-        if emit_peer != node_id and recv_peer != node_id:
-            # unsubscription requests are always initially send to the
-            # emitter peer. Recv_peer can only be matched to our id if
-            # a subscription to a receiver is done by the emitter.
-            logger.warning("ZOCP UNSUB   : invalid unsubscription request: %s" % data)
-            return
-
-        if recv_peer != peer:
-            # check if this should be forwarded (third party unsubscription request)
-            logger.debug("ZOCP UNSUB   : forwarding unsubscription request: %s" % data)
-            self.signal_unsubscribe(emit_peer, emitter, recv_peer, receiver)
-            return
-
-        if emitter is not None:
+        return modified
+
+    def _subscribed_otherwise(self, recv_peer, receiver, path, emitter):
+        """
+        Returns True if a receiver of a peer is subscribed to the
+        parameter at path other than through emitter, either by its path
+        or through another pattern
+        """
+        subscriptions = self.subscribers.get(recv_peer, {})
+        for other in [path] + list(self._pattern_paths.get(path, ())):
+            if other != emitter and receiver in subscriptions.get(other, ()):
+                return True
+        return False
+
+    def _remove_subscriber(self, recv_peer, receiver, emitter):
+        """
+        Unsubscribe a receiver of a peer from our emitter, returns a list
+        of (keys, parameter) of which the subscribers changed and whether
+        the receiver was subscribed
+        """
+        subscriber = (recv_peer.hex, receiver)
+        modified = []
+        if is_pattern(emitter):
+            pattern_subscribers = self._patterns.get(emitter, set())
+            pattern_subscribers.discard(subscriber)
+            for path, patterns in list(self._pattern_paths.items()):
+                if emitter in patterns:
+                    keys, param = self._params[path]
+                    subscribers = param_subscribers(param)
+                    if subscriber in subscribers and not self._subscribed_otherwise(
+                            recv_peer, receiver, path, emitter):
+                        subscribers.discard(subscriber)
+                        modified.append((keys, param))
+                    if not pattern_subscribers:
+                        patterns.discard(emitter)
+                        if not patterns:
+                            self._pattern_paths.pop(path)
+            if not pattern_subscribers:
+                self._patterns.pop(emitter, None)
+
+        elif emitter is not None:
             # update subscribers in capability tree
-            subscriber = (recv_peer.hex, receiver)
-            subscribers = self.capability[emitter]["subscribers"]
-            if subscriber in subscribers:
-                subscribers.remove(subscriber)
-                self._on_modified(data={emitter: {"subscribers": subscribers}})
+            keys, param = self._get_param(emitter)
+            subscribers = param_subscribers(param)
+            if subscriber in subscribers and not self._subscribed_otherwise(
+                    recv_peer, receiver, emitter, emitter):
+                subscribers.discard(subscriber)
+                modified.append((keys, param))
 
         if (recv_peer in self.subscribers and
                 emitter in self.subscribers[recv_peer] and
                 receiver in self.subscribers[recv_peer][emitter]):
-            self.subscribers[recv_peer][emitter].remove(receiver)
-            if not any(self.subscribers[recv_peer][emitter]):
+            self.subscribers[recv_peer][emitter].discard(receiver)
+            if not self.subscribers[recv_peer][emitter]:
                 self.subscribers[recv_peer].pop(emitter)
-            if not any(self.subscribers[recv_peer]):
+            if not self.subscribers[recv_peer]:
                 self.subscribers.pop(recv_peer)
-
-            self.on_peer_unsubscribed(peer, name, data)
-        return
+            return modified, True
+        return modified, False
 
     def _handle_REP(self, data, peer, name, grp):
-        return
+        request_id = data[0]
+        request = self._pending.get(request_id)
+        if request is None or request[1] != peer:
+            logger.debug("ZOCP REP     : no pending request %s for %s" %(request_id, name))
+            return
+        self._pending.pop(request_id)
+        future, req_peer, method, deadline = request
+        if len(data) > 2 and data[2] is not None:
+            future.set_exception(ZOCPRequestError(data[2]))
+        else:
+            result = data[1]
+            if method == 'GET':
+                # keep our copy of the peer's capability up to date
+                self._handle_MOD(result, peer, name, grp)
+            elif method == 'CALLS':
+                result = [ZOCPRequestError(error) if error is not None else value
+                          for value, error in result]
+            future.set_result(result)
+        self.on_peer_replied(peer, name, data)
 
     def _handle_MOD(self, data, peer, name, grp):
-        self.peers_capabilities[peer] = dict_merge(self.peers_capabilities.get(peer), data)
-        self.on_peer_modified(peer, name, data)
+        capability = self.peers_capabilities.get(peer)
+        if isinstance(data, LazyCapability) and not data.is_loaded():
+            self._add_lazy_MOD(data, peer, name, capability)
+        else:
+            if capability is None:
+                capability = self.peers_capabilities[peer] = {}
+            diff = self._merge_peer(peer, capability, data)
+            if diff:
+                self._run_callback(peer, self.on_peer_modified, peer, name, diff)
+        # a peer of protocol 1 answers a GET with a MOD
+        untagged = self._untagged.get(peer)
+        while untagged:
+            request = self._pending.pop(untagged.popleft(), None)
+            if request is not None:
+                request[0].set_result(data)
+                break
+
+    def _add_lazy_MOD(self, data, peer, name, capability):
+        """
+        Keep the undecoded MOD messages of data in the capability of a
+        peer, on_peer_modified is fired with the effective changes when
+        they are merged on access
+        """
+        if not isinstance(capability, LazyCapability):
+            capability = LazyCapability(capability or ())
+            self.peers_capabilities[peer] = capability
+        capability.loader = functools.partial(self._load_lazy, peer, name, capability)
+        for raw in data._pending:
+            capability.add_message(raw)
+
+    def _load_lazy(self, peer, name, capability, data):
+        diff = self._merge_peer(peer, capability, data)
+        if diff:
+            self._run_callback(peer, self.on_peer_modified, peer, name, diff)
+
+    def _fetch_capability(self, peer):
+        """
+        Request the complete capability of a peer, the peer sends its
+        version along
+        """
+        if self.lazy_capabilities:
+            # an untagged GET is answered with a MOD we don't decode
+            self._send(peer, 'GET', encode_message({'GET': None}))
+        else:
+            self.peer_get_capability(peer)
+
+    def _remember_peer(self, peer):
+        """
+        Store the state of an exiting peer in the cache of departed peers
+        """
+        capability = self.peers_capabilities.get(peer)
+        if capability is None:
+            return
+        state = {
+            'capability': capability,
+            'subscriptions': self.subscriptions.get(peer),
+            'subscribers': self.subscribers.get(peer),
+            'version': self._peer_versions.pop(peer, None),
+        }
+        if isinstance(capability, LazyCapability) and not capability.is_loaded():
+            size = capability.raw_size()
+        else:
+            size = len(encode_message(capability))
+        size += len(encode_message([state['subscriptions'], state['subscribers']]))
+        self.departed_peers.put(peer, state, size)
+
+    def _restore_peer(self, peer, name, state):
+        """
+        Restore the state of a returning peer and check whether its
+        capability changed while it was away. Values changed meanwhile
+        are only updated by the next signals of the peer.
+        """
+        capability = state['capability']
+        if isinstance(capability, LazyCapability) and not capability.is_loaded():
+            self.peers_capabilities[peer] = capability
+            self._mark_dirty(peer, ())
+        else:
+            self.peers_capabilities[peer] = {}
+            diff = self._merge_peer(peer, self.peers_capabilities[peer], capability)
+            if diff:
+                self._run_callback(peer, self.on_peer_modified, peer, name, diff)
+        if state['subscriptions']:
+            self.subscriptions[peer] = state['subscriptions']
+        if state['subscribers']:
+            self.subscribers[peer] = state['subscribers']
+        self._receivers.clear()
+        if self._peer_protocol(peer) < 2:
+            # older peers have no version to compare
+            self._fetch_capability(peer)
+            return
+        self.peer_get_version(peer).add_done_callback(
+                functools.partial(self._check_peer_version, peer, state['version']))
+
+    def _check_peer_version(self, peer, version, future):
+        if peer not in self.peers_capabilities:
+            return
+        if version is not None and not future.cancelled() \
+                and future.exception() is None and future.result() == version:
+            self._peer_versions[peer] = version
+        else:
+            # the peer changed while it was away
+            self._fetch_capability(peer)
+
+    def _resubscribe(self, peer, name):
+        """
+        Subscribe again to all emitters of a returning peer in one batch
+        """
+        subscriptions = self.subscriptions.setdefault(peer, {})
+        subs = []
+        for emitter, receivers in self._intended[peer].items():
+            current = subscriptions.setdefault(emitter, OrderedSet())
+            for receiver in receivers:
+                current.add(receiver)
+                subs.append([peer.hex, emitter, self.get_uuid().hex, receiver])
+        self._receivers.clear()
+        exit_time = self._exit_times.pop(peer, None)
+        if self._peer_protocol(peer) < 2:
+            # older peers don't know SUBS and don't reply to SUB
+            self._whisper_subscriptions(peer, 'SUB', subs)
+            self._resubscribed(peer, name, exit_time, None)
+            return
+        # the emitter ignores subscriptions it still knows of
+        future = self._request(peer, 'SUBS', subs)
+        future.add_done_callback(functools.partial(
+                self._resubscribed, peer, name, exit_time))
+
+    def _resubscribed(self, peer, name, exit_time, future):
+        if future is not None:
+            if future.cancelled() or peer not in self.peers_capabilities:
+                return
+            if future.exception() is not None:
+                logger.warning("ZOCP SUBS    : %s failed to subscribe again: %s"
+                               %(name, future.exception()))
+                return
+        if exit_time is not None:
+            self._run_callback(peer, self.on_peer_resubscribed, peer, name, _clock() - exit_time)
+
+    def _load_peers(self):
+        for capability in list(self.peers_capabilities.values()):
+            if isinstance(capability, LazyCapability):
+                capability.load()
+
+    def _merge_peer(self, peer, capability, data):
+        """
+        Merge data into the capability of a peer and update the indexes,
+        returns the effective changes
+        """
+        # store new parameters of the peer as compact records
+        compact_params(data)
+        diff = dict_merge_diff(capability, data)
+        if diff and self.peers_capabilities.get(peer) is capability:
+            params = self._peer_params.setdefault(peer, {})
+            paths = self._index_params(params, capability, diff)
+            # parameters of objects which changed type need reindexing
+            for obj_keys in dict_walk_types(diff):
+                prefix = ".".join(obj_keys) + "."
+                paths.extend(path for path in params if path.startswith(prefix))
+            for path in set(paths):
+                keys, param = params[path]
+                parent = dict_get(capability, keys[:-1]) if len(keys) > 1 else None
+                obj_type = parent.get('type') if isinstance(parent, dict) else None
+                self._query_index.add(peer, keys, param, obj_type)
+            for key in diff:
+                self._mark_dirty(peer, (key,))
+        return diff
 
     def _handle_SIG(self, data, peer, name, grp):
-        [emitter, value] = data
-        if emitter in self.peers_capabilities[peer]:
-            self.peers_capabilities[peer][emitter].update({'value': value})
-
-        if peer in self.subscriptions:
-            subscription = self.subscriptions[peer]
-            if emitter in subscription:
-                receivers = subscription[emitter]
-                for receiver in receivers:
-                    # add a list of sensors on this node receiving the signal
-                    if len(data) == 2:
-                        data.append([receiver])
-                    else:
-                        data[2].append(receiver)
-
-                    # propagate the signal if it changes the value of this node
-                    if receiver is not None and self.capability[receiver]['value'] != value:
-                        self.emit_signal(receiver, value)
-
-            if None in subscription or emitter in subscription:
-                self.on_peer_signaled(peer, name, data)
-
-    def _on_modified(self, data, peer=None, name=None):
-        if self._cur_obj_keys:
-            # the last key in the _cur_obj_keys list equals 
-            # the first in data so skip the last key
-            for key in self._cur_obj_keys[::-1]:
-                new_data = {}
-                new_data[key] = data
-                data = new_data
-        self.on_modified(peer, name, data)
-
-        if len(data) == 1:
-            # if the only modification is a value change,
-            # emit a SIG instead of a MOD
-            name = list(data.keys())[0]
-            if len(data[name]) == 1 and 'value' in data[name]:
-                msg = json.dumps({'SIG': [name, data[name]['value']]})
-                for subscriber in self.subscribers:
-                    # no need to send the signal to the node that
-                    # modified the value
-                    if subscriber != peer and (
-                            None in self.subscribers[subscriber] or
-                            name in self.subscribers[subscriber]):
-                        self.whisper(subscriber, msg.encode('utf-8'))
-                data = {}
-
-        if any(data):
-            msg = json.dumps({ 'MOD' :data}).encode('utf-8')
+        self._receive_signals([data], peer, name)
+
+    def _handle_SIGS(self, data, peer, name, grp):
+        self._receive_signals(data, peer, name)
+
+    def _receive_local(self, signals, peer, name, hop):
+        """
+        Receive signals of a node in this process
+        """
+        self._metrics.message_in(peer, ('SIG' if len(signals) == 1 else 'SIGS',), 0)
+        self._cur_hop = hop
+        self._receive_signals(signals, peer, name)
+        self._cur_hop = None
+
+    def _receive_signals(self, signals, peer, name):
+        """
+        Update our mirror of the peer, fire on_peer_signaled and forward
+        the signals which change the values of our receivers in a single
+        fan-out
+        """
+        hops, origin = self._cur_hop or (0, None)
+        if hops:
+            stats = self._route_stats.setdefault(hops, [0, 0.0])
+            stats[0] += 1
+            stats[1] += time.time() - origin
+        # receiver : value to forward
+        forward = collections.OrderedDict()
+        for data in signals:
+            [emitter, value] = data
+            self._metrics.signal_in(peer, emitter)
+            entry = self._peer_params.get(peer, {}).get(emitter)
+            if entry is None:
+                capability = self.peers_capabilities.get(peer)
+                if isinstance(capability, LazyCapability) and not capability.is_loaded():
+                    capability.load([emitter.split('.', 1)[0]])
+                    entry = self._peer_params.get(peer, {}).get(emitter)
+            if entry is not None:
+                entry[1]['value'] = value
+                self._mark_dirty(peer, entry[0])
+
+            if peer in self.subscriptions:
+                subscription = self.subscriptions[peer]
+                receivers = self._get_receivers(peer, emitter)
+                if receivers:
+                    for receiver in receivers:
+                        # add a list of sensors on this node receiving the signal
+                        if len(data) == 2:
+                            data.append([receiver])
+                        else:
+                            data[2].append(receiver)
+
+                        # propagate the signal if it changes the value of this node
+                        if receiver is not None and not _same_value(
+                                self._get_param(receiver)[1]['value'], value):
+                            forward[receiver] = value
+
+                if None in subscription or receivers:
+                    key = (peer, emitter) if self._callback_per_emitter else peer
+                    self._run_callback(key, self.on_peer_signaled, peer, name, data)
+
+        if forward:
+            if hops >= self.max_signal_hops:
+                # our receivers still take the values
+                logger.warning("ZOCP SIG     : not forwarding signals from %s after %d hops, "
+                               "is there a cycle in the routes?" %(name, hops))
+                self._set_values(list(forward.items()))
+                return
+            self._emit(list(forward.items()), hops + 1, origin or time.time())
+
+    def _on_modified(self, data, peer=None, name=None, keys=None):
+        """
+        Inform subscribers of a modification of our capability
+
+        data is relative to the object at keys, which defaults to the
+        current object set using set_object. Passing the object itself
+        as data, after modifying it in place, reindexes its parameters.
+        """
+        if keys is None:
+            keys = self._cur_obj_keys
+        node = dict_get(self.capability, keys)
+        if data is node:
+            self._reindex_params(keys)
+        structural = not dict_changes_values(node, data)
+        for key in data:
+            self._mark_dirty(None, keys + (key,), structural)
+        # if the only modification is a value change of a single
+        # parameter emit a SIG instead of a MOD
+        signal = None
+        node = data
+        path = keys
+        while isinstance(node, dict) and len(node) == 1:
+            key = list(node.keys())[0]
+            node = node[key]
+            path = path + (key,)
+            if isinstance(node, dict) and len(node) == 1 and 'value' in node:
+                signal = [".".join(path), node['value']]
+                break
+
+        # the last key in the keys list equals
+        # the first in data so skip the last key
+        for key in keys[::-1]:
+            new_data = {}
+            new_data[key] = data
+            data = new_data
+        self._run_callback(peer, self.on_modified, peer, name, data)
+
+        if signal is not None:
+            signals = [tuple(signal)]
+            messages = {}
+            for subscriber in self.subscribers:
+                # no need to send the signal to the node that
+                # modified the value
+                if subscriber != peer and self._is_subscribed(
+                        self.subscribers[subscriber], signal[0]) \
+                        and not self._throttle(subscriber, signals):
+                    self._send_signals(subscriber, signals, cache=messages, key=0)
+
+        elif data and self.subscribers:
+            msg = encode_message({ 'MOD' :data})
+            # the parameters touched by the modification
+            paths = set(".".join(param_keys) for param_keys, param in
+                        dict_walk_params(self.capability, data))
+            paths.update(data.keys())
             for subscriber in self.subscribers:
                 # inform node that are subscribed to one or more
                 # updated capabilities that they have changed
-                if subscriber != peer and (
-                        None in self.subscribers[subscriber] or
-                        len(set(self.subscribers[subscriber]) & set(data)) > 0):
-                    self.whisper(subscriber, msg)
+                subscriptions = self.subscribers[subscriber]
+                if subscriber != peer and any(
+                        self._is_subscribed(subscriptions, path) for path in paths):
+                    self._send(subscriber, 'MOD', msg)
+
+    def get_fd(self):
+        """
+        Return a file descriptor which becomes readable when run_once(0)
+        has work to do, to run ZOCP from another event loop
+
+        It covers the received messages as well as the work other
+        threads hand to the loop, like signals of nodes in this process
+        and the replies of threaded calls. Only watching the inbox
+        misses the latter. Needs epoll or kqueue.
+
+        Requests time out and _stats are published when run_once runs,
+        so call it as well after get_timeout() milliseconds.
+        """
+        if self._fd_poller is None:
+            fds = [sock.getsockopt(zmq.FD) for sock in (self.inbox, self._wake_recv)]
+            if hasattr(select, 'epoll'):
+                self._fd_poller = select.epoll()
+                for fd in fds:
+                    self._fd_poller.register(fd, select.EPOLLIN)
+            elif hasattr(select, 'kqueue'):
+                self._fd_poller = select.kqueue()
+                self._fd_poller.control([select.kevent(fd, select.KQ_FILTER_READ, select.KQ_EV_ADD)
+                                         for fd in fds], 0)
+            else:
+                raise NotImplementedError("get_fd needs epoll or kqueue")
+        return self._fd_poller.fileno()
+
+    def get_timeout(self):
+        """
+        Return the milliseconds until run_once has to run to time out
+        requests or publish _stats, None if nothing is due
+        """
+        deadlines = [d for (f, p, m, d) in list(self._pending.values()) if d is not None]
+        if self._stats_due is not None:
+            deadlines.append(self._stats_due)
+        if not deadlines:
+            return None
+        return max(0, int((min(deadlines) - _clock()) * 1000) + 1)
 
     def run_once(self, timeout=None):
         """
@@ -794,13 +3623,7 @@ class ZOCP(Pyre):
         The timeout is in milliseconds
         """
         self._running = True
-        items = dict(self.poller.poll(timeout))
-        while(len(items) > 0):
-            for fd, ev in items.items():
-                if self.inbox == fd and ev == zmq.POLLIN:
-                    self.get_message()
-            # just q quick query
-            items = dict(self.poller.poll(0))
+        self._poll(timeout)
 
     def run(self, timeout=None):
         """
@@ -809,18 +3632,229 @@ class ZOCP(Pyre):
         self._running = True
         while(self._running):
             try:
-                items = dict(self.poller.poll(timeout))
-                while(len(items) > 0):
-                    for fd, ev in items.items():
-                        if self.inbox == fd and ev == zmq.POLLIN:
-                            self.get_message()
+                self._poll(timeout)
             except (KeyboardInterrupt, SystemExit):
                 break
         self.stop()
 
+    def _poll(self, timeout):
+        self._loop_thread = threading.current_thread()
+        # don't block beyond the first pending request deadline
+        wait = self.get_timeout()
+        if wait is not None and (timeout is None or wait < timeout):
+            timeout = wait
+        items = dict(self.poller.poll(timeout))
+        while(len(items) > 0):
+            # handle the received messages first, so signals delivered
+            # locally don't overtake messages which arrived before them
+            while items.get(self.inbox) == zmq.POLLIN:
+                self.get_message()
+                items = dict(self.poller.poll(0))
+            if items.get(self._wake_recv) == zmq.POLLIN:
+                self._run_soon()
+            # just q quick query
+            items = dict(self.poller.poll(0))
+        if self._pending:
+            self._expire_requests()
+        if self._stats_due is not None and _clock() >= self._stats_due:
+            self._publish_stats()
+        if self._snapshots_used and self._dirty:
+            self._publish_snapshot()
+
+    def _publish_stats(self):
+        self._stats_due = _clock() + self._stats_interval
+        stats = self._metrics.totals()
+        for histogram in ('dispatch', 'callbacks'):
+            for name, fraction in (('p50', 0.5), ('p99', 0.99)):
+                stats[histogram + '_' + name] = getattr(
+                        self._metrics, histogram).percentile(fraction)
+        self.capability['_stats'] = stats
+        self._on_modified(data={'_stats': stats}, keys=())
+
+    def stop(self):
+        """
+        Stop the node and the worker pool of threaded calls
+        """
+        if _local_nodes.get(self.get_uuid()) is self:
+            del _local_nodes[self.get_uuid()]
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._transport is None:
+            super(ZOCP, self).stop()
+        else:
+            self._transport.stop()
+        self.poller.unregister(self._wake_recv)
+        if self._fd_poller is not None:
+            self._fd_poller.close()
+            self._fd_poller = None
+        self._wake_send.close(linger=0)
+        self._wake_recv.close(linger=0)
+
     #def __del__(self):
     #    self.stop()
 
+def _transport_method(name):
+    def method(self, *args, **kwargs):
+        if self._transport is None:
+            return getattr(Pyre, name)(self, *args, **kwargs)
+        return getattr(self._transport, name)(*args, **kwargs)
+    method.__name__ = name
+    # newer versions of pyre may lack some of them
+    method.__doc__ = getattr(getattr(Pyre, name, None), '__doc__', None)
+    return method
+
+# the Pyre methods ZOCP uses, passed on to the transport if it has one
+for _name in ('start', 'get_uuid', 'get_name', 'set_name', 'set_header',
+              'join', 'leave', 'whisper', 'shout', 'recv', 'get_peers',
+              'get_peer_address', 'get_peer_header_value',
+              'get_own_groups', 'get_peer_groups'):
+    setattr(ZOCP, _name, _transport_method(_name))
+
+class ZOCPRelay(ZOCP):
+    """
+    Node relaying emitters of other nodes to many subscribers
+
+    The relay subscribes once to the relayed emitters and serves them
+    as its own parameters, at 'relay.<peer hex>.<emitter>'. Observers
+    subscribe to the relay instead of the source, which keeps a fixed
+    fan-out however many observers join. GETs are served from the
+    relay's copy. The rate of signals to each subscriber can be limited
+    using set_qos.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ZOCPRelay, self).__init__(*args, **kwargs)
+        # source peer id : set of relayed emitters, None relays all
+        self._relayed = {}
+        # subscriber id : minimum seconds between signals
+        self._qos = {}
+        # subscriber id : time signals were last sent
+        self._last_sent = {}
+        # subscriber id : OrderedDict of emitter : value held back
+        self._held = {}
+
+    def relay(self, peer, emitter=None):
+        """
+        Relay an emitter of a peer, or all its emitters if emitter is
+        None. Glob patterns are supported like in signal_subscribe.
+        """
+        self._relayed.setdefault(peer, set()).add(emitter)
+        if emitter is not None and not is_pattern(emitter):
+            # register it now so observers can subscribe to it
+            entry = self._peer_params.get(peer, {}).get(emitter)
+            self._relay_param(peer, emitter, entry[1].get('value') if entry else None)
+        self.signal_subscribe(self.get_uuid(), None, peer, emitter)
+
+    def unrelay(self, peer, emitter=None):
+        """
+        Stop relaying an emitter of a peer
+        """
+        relayed = self._relayed.get(peer, set())
+        relayed.discard(emitter)
+        if not relayed:
+            self._relayed.pop(peer, None)
+        self.signal_unsubscribe(self.get_uuid(), None, peer, emitter)
+
+    def set_qos(self, subscriber, max_rate=None):
+        """
+        Limit the number of signal messages per second sent to a
+        subscriber, None removes the limit. Signals held back are
+        coalesced, only the latest value of each emitter is sent.
+        """
+        if max_rate is None:
+            self._qos.pop(subscriber, None)
+            self._flush(subscriber)
+        else:
+            self._qos[subscriber] = 1.0 / max_rate
+
+    def get_relay_path(self, peer, emitter):
+        """
+        Return the path of the relayed emitter of a peer on this node
+        """
+        return "relay.%s.%s" %(peer.hex, emitter)
+
+    def _is_relayed(self, peer, emitter):
+        relayed = self._relayed.get(peer)
+        if relayed is None:
+            return False
+        if None in relayed or emitter in relayed:
+            return True
+        return any(is_pattern(pattern) and compile_pattern(pattern).match(emitter)
+                   for pattern in relayed if pattern is not None)
+
+    def _relay_param(self, peer, emitter, value):
+        """
+        Return the path of the parameter relaying an emitter of a peer,
+        registering it when first relayed
+        """
+        path = self.get_relay_path(peer, emitter)
+        if path in self._params:
+            return path
+        keys = ('relay', peer.hex) + tuple(emitter.split('.'))
+        param = Parameter(value=_copy_value(value), access='re', subscribers=OrderedSet())
+        entry = self._peer_params.get(peer, {}).get(emitter)
+        if entry is not None:
+            source = entry[1]
+            # relays don't forward writes
+            param['access'] = source.get('access', 'r').replace('w', '')
+            for field in ('typeHint', 'min', 'max', 'step'):
+                if field in source:
+                    param[field] = source[field]
+        obj = self.capability
+        for key in keys[:-1]:
+            obj = obj.setdefault(key, {})
+        obj[keys[-1]] = param
+        self._params[path] = (keys, param)
+        self._match_patterns([path])
+        self._on_modified(data={keys[-1]: param}, keys=keys[:-1])
+        return path
+
+    def _receive_signals(self, signals, peer, name):
+        super(ZOCPRelay, self)._receive_signals(signals, peer, name)
+        relayed = [(self._relay_param(peer, data[0], data[1]), _copy_value(data[1]))
+                   for data in signals if self._is_relayed(peer, data[0])]
+        if relayed:
+            self._emit(relayed)
+
+    def _throttle(self, subscriber, signals):
+        interval = self._qos.get(subscriber)
+        if interval is None:
+            return False
+        held = self._held.get(subscriber)
+        last_sent = self._last_sent.get(subscriber)
+        if held is None and (last_sent is None or _clock() - last_sent >= interval):
+            self._last_sent[subscriber] = _clock()
+            return False
+        if held is None:
+            held = self._held[subscriber] = collections.OrderedDict()
+        for emitter, value in signals:
+            held.pop(emitter, None)
+            held[emitter] = value
+        return True
+
+    def _flush(self, subscriber):
+        held = self._held.pop(subscriber, None)
+        if held:
+            self._last_sent[subscriber] = _clock()
+            self._send_signals(subscriber, list(held.items()))
+
+    def _poll(self, timeout):
+        # wake up when held back signals are due
+        if self._held:
+            due = min(self._last_sent.get(s, 0) + self._qos.get(s, 0) for s in self._held)
+            wait = max(0, int((due - _clock()) * 1000) + 1)
+            if timeout is None or wait < timeout:
+                timeout = wait
+        super(ZOCPRelay, self)._poll(timeout)
+        now = _clock()
+        for subscriber in list(self._held):
+            if subscriber not in self.subscribers:
+                self._held.pop(subscriber)
+            elif now - self._last_sent.get(subscriber, 0) >= self._qos.get(subscriber, 0):
+                self._flush(subscriber)
+
+
 if __name__ == '__main__':
 
     z = ZOCP()
@@ -2,6 +2,11 @@ import unittest
 import zocp
 import zmq
 import time
+import json
+import select
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import sys
 
 
@@ -12,22 +17,21 @@ if sys.version.startswith('3'):
 class ZOCPTest(unittest.TestCase):
     
     def setUp(self, *args, **kwargs):
-        ctx = zmq.Context()
-        self.node1 = zocp.ZOCP(ctx=ctx)
+        self.network = zocp.MemoryNetwork()
+        self.node1 = zocp.ZOCP(transport=self.network.transport())
         self.node1.set_header("X-TEST", "1")
         self.node1.set_name("node1")
-        self.node2 = zocp.ZOCP(ctx=ctx)
+        self.node2 = zocp.ZOCP(transport=self.network.transport())
         self.node2.set_header("X-TEST", "1")
         self.node2.set_name("node2")
         self.node1.start()
         self.node2.start()
-        # give time for nodes to exchange
-        time.sleep(1)
     # end setUp
 
     def tearDown(self):
         self.node1.stop()
         self.node2.stop()
+        self.network.close()
     # end tearDown
 
     def test_get_name(self):
@@ -63,9 +67,6 @@ class ZOCPTest(unittest.TestCase):
         self.node1.join("TEST")
         self.node2.join("TEST")
 
-        # pyre works asynchronous so give some time to let changes disperse
-        time.sleep(0.5)
-
         self.assertIn("TEST", self.node1.get_own_groups())
         self.assertIn("TEST", self.node2.get_own_groups())
     # end test_get_own_groups
@@ -74,9 +75,6 @@ class ZOCPTest(unittest.TestCase):
         self.node1.join("TEST")
         self.node2.join("TEST")
 
-        # pyre works asynchronous so give some time to let changes disperse
-        time.sleep(0.5)
-
         self.assertIn("TEST", self.node1.get_peer_groups())
         self.assertIn("TEST", self.node2.get_peer_groups())
     # end test_get_peer_groups
@@ -88,15 +86,14 @@ class ZOCPTest(unittest.TestCase):
         self.node1.run_once()
         self.node2.run_once()
         self.node2.signal_subscribe(self.node2.get_uuid(), "TestRecvFloat", self.node1.get_uuid(), "TestEmitFloat")
-        # give time for dispersion
-        time.sleep(0.5)
+        # the receiving node sends no requests to itself
+        self.assertNotIn(self.node2.get_uuid(), self.node2.get_metrics()["peers"])
         self.node1.run_once()
         # subscriptions structure: {Emitter nodeID: {'EmitterID': ['Local ReceiverID']}}
         self.assertIn("TestRecvFloat", self.node2.subscriptions[self.node1.get_uuid()]["TestEmitFloat"])
         self.assertIn("TestRecvFloat", self.node1.subscribers[self.node2.get_uuid()]["TestEmitFloat"])
         # unsubscribe
         self.node2.signal_unsubscribe(self.node2.get_uuid(), "TestRecvFloat", self.node1.get_uuid(), "TestEmitFloat")
-        time.sleep(0.5)
         self.node1.run_once()
         self.assertNotIn("TestRecvFloat", self.node2.subscriptions.get(self.node1.get_uuid(), {}).get("TestEmitFloat", {}))
         self.assertNotIn("TestRecvFloat", self.node1.subscribers.get(self.node2.get_uuid(), {}).get("TestEmitFloat", {}))
@@ -104,21 +101,886 @@ class ZOCPTest(unittest.TestCase):
     def test_emit_signal(self):
         self.node1.register_float("TestEmitFloat", 1.0, 'rwe')
         self.node2.register_float("TestRecvFloat", 1.0, 'rws')
-        # give time for dispersion
-        time.sleep(0.5)
         self.node1.run_once()
         self.node2.signal_subscribe(self.node2.get_uuid(), "TestRecvFloat", self.node1.get_uuid(), "TestEmitFloat")
-        # give time for dispersion
-        time.sleep(0.1)
         self.node1.run_once()
         self.node1.emit_signal("TestEmitFloat", 2.0)
-        time.sleep(0.1)
         self.node2.run_once()
         self.assertEqual(2.0, self.node2.capability["TestRecvFloat"]["value"])
         # unsubscribe
         self.node2.signal_unsubscribe(self.node2.get_uuid(), "TestRecvFloat", self.node1.get_uuid(), "TestEmitFloat")
-        time.sleep(0.1)
         self.node1.run_once()
+
+    def test_capability_json(self):
+        self.node1.register_float("TestEmitFloat", 1.0, 'rwe')
+        self.node2.register_float("TestRecvFloat", 1.0, 'rws')
+        self.node1.run_once()
+        self.node2.signal_subscribe(self.node2.get_uuid(), "TestRecvFloat", self.node1.get_uuid(), "TestEmitFloat")
+        self.node1.run_once()
+        capability = json.loads(json.dumps(self.node1.get_capability()))
+        self.assertEqual(1.0, capability["TestEmitFloat"]["value"])
+        self.assertEqual([[self.node2.get_uuid().hex, "TestRecvFloat"]], capability["TestEmitFloat"]["subscribers"])
+        self.assertIn(".TestEmitFloat.value", zocp.dict_get_keys(self.node1.capability))
+
+    def test_register_method(self):
+        received = []
+        def handle_echo(data, peer, name, grp):
+            received.append((data, peer))
+        self.node1.register_method("ECHO", handle_echo)
+        self.node2.whisper(self.node1.get_uuid(), json.dumps({"ECHO": 1, "UNKNOWN": 2}).encode('utf-8'))
+        self.node1.run_once(0)
+        self.assertEqual([(1, self.node2.get_uuid())], received)
+        self.assertEqual(1, self.node1.get_method_stats()["ECHO"]["count"])
+        self.assertNotIn("UNKNOWN", self.node1.get_method_stats())
+
+    def test_peer_get_future(self):
+        self.node1.register_float("TestFloat", 1.0, 'rw')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        future = self.node2.peer_get(self.node1.get_uuid(), ["TestFloat"])
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.assertTrue(future.done())
+        self.assertEqual(1.0, future.result()["TestFloat"]["value"])
+        self.assertEqual(1.0, self.node2.peers_capabilities[self.node1.get_uuid()]["TestFloat"]["value"])
+
+    def test_peer_get_from_thread(self):
+        self.node1.register_float("TestFloat", 1.0, 'rw')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.node1.run_once(0)
+        gets = lambda: self.node1.get_metrics()["methods"].get("GET", {}).get("messages_in", 0)
+        before = gets()
+        futures = []
+        done = []
+        thread = threading.Thread(target=lambda: futures.append(
+                self.node2.peer_get(self.node1.get_uuid(), ["TestFloat"])))
+        thread.start()
+        thread.join()
+        futures[0].add_done_callback(done.append)
+        # the request is sent by the thread running the loop
+        self.node1.run_once(0)
+        self.assertEqual(before, gets())
+        self.node2.run_once(0)
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.assertEqual(1.0, futures[0].result(0)["TestFloat"]["value"])
+        self.node2.run_once(0)
+        self.assertEqual(futures, done)
+
+    def legacy_peer(self):
+        # a bare transport stands in for a node of protocol 1
+        peer = self.network.transport()
+        peer.set_header("X-ZOCP", "1")
+        peer.start()
+        return peer
+
+    def legacy_received(self, peer):
+        received = []
+        while peer.inbox.poll(0):
+            msg = peer.recv()
+            if msg[0] == b"WHISPER":
+                received.append(json.loads(msg[3].decode('utf-8')))
+        return received
+
+    def test_legacy_requests(self):
+        peer = self.legacy_peer()
+        try:
+            # the capability is fetched without a request id
+            self.node2.run_once(0)
+            self.assertEqual([{'GET': None}], self.legacy_received(peer))
+            peer.whisper(self.node2.get_uuid(), json.dumps({'MOD': {}}).encode('utf-8'))
+            self.node2.run_once(0)
+            # replies are matched to the GETs in order
+            future = self.node2.peer_get(peer.get_uuid(), ["TestFloat"])
+            self.assertEqual([{'GET': ["TestFloat"]}], self.legacy_received(peer))
+            peer.whisper(self.node2.get_uuid(), json.dumps({'MOD': {"TestFloat": {"value": 1.0}}}).encode('utf-8'))
+            self.node2.run_once(0)
+            self.assertEqual({"TestFloat": {"value": 1.0}}, future.result(0))
+            self.assertIsNone(self.node2.peer_set(peer.get_uuid(), {"TestFloat": {"value": 2.0}}).result(0))
+            self.assertEqual([{'SET': {"TestFloat": {"value": 2.0}}}], self.legacy_received(peer))
+            self.assertIsInstance(self.node2.peer_call(peer.get_uuid(), "add", 1, 2).exception(0),
+                                  zocp.ZOCPRequestError)
+        finally:
+            peer.stop()
+
+    def test_legacy_get(self):
+        peer = self.legacy_peer()
+        try:
+            self.node1.run_once(0)
+            self.legacy_received(peer)
+            peer.whisper(self.node1.get_uuid(), json.dumps({'GET': None}).encode('utf-8'))
+            self.node1.run_once(0)
+            # the capability is sent without a VER, which older peers don't know
+            self.assertEqual([['MOD']], [list(msg) for msg in self.legacy_received(peer)])
+        finally:
+            peer.stop()
+
+    def test_legacy_signals(self):
+        peer = self.legacy_peer()
+        try:
+            self.node1.register_float("TestFloat", 1.0, 'rwe')
+            self.node1.register_int("TestInt", 1, 'rwe')
+            self.node1.run_once(0)
+            for emitter in ("TestFloat", "TestInt"):
+                sub = [self.node1.get_uuid().hex, emitter, peer.get_uuid().hex, None]
+                peer.whisper(self.node1.get_uuid(), json.dumps({'SUB': sub}).encode('utf-8'))
+                self.node1.run_once(0)
+            self.legacy_received(peer)
+            # older peers get single SIGs
+            self.node1.emit_signals([("TestFloat", 2.0), ("TestInt", 2)])
+            self.assertEqual([{'SIG': ["TestFloat", 2.0]}, {'SIG': ["TestInt", 2]}],
+                             self.legacy_received(peer))
+        finally:
+            peer.stop()
+
+    def test_legacy_forward(self):
+        peer = self.legacy_peer()
+        try:
+            self.node1.register_float("TestEmitFloat", 1.0, 'rwe')
+            self.node2.register_float("TestRecvFloat", 1.0, 'rwse')
+            self.node2.signal_subscribe(self.node2.get_uuid(), "TestRecvFloat", self.node1.get_uuid(), "TestEmitFloat")
+            self.node1.run_once(0)
+            sub = [self.node2.get_uuid().hex, "TestRecvFloat", peer.get_uuid().hex, None]
+            peer.whisper(self.node2.get_uuid(), json.dumps({'SUB': sub}).encode('utf-8'))
+            self.node2.run_once(0)
+            self.legacy_received(peer)
+            self.node1.emit_signal("TestEmitFloat", 2.0)
+            self.node2.run_once(0)
+            # forwarded signals reach older peers without their hops
+            self.assertEqual([{'SIG': ["TestRecvFloat", 2.0]}], self.legacy_received(peer))
+        finally:
+            peer.stop()
+
+    def test_get_fd(self):
+        readable = lambda: bool(select.select([self.node2.get_fd()], [], [], 0)[0])
+        self.node2.run_once(0)
+        self.assertFalse(readable())
+        # work handed over by other threads wakes the fd as well
+        thread = threading.Thread(target=self.node2.peer_get, args=(self.node1.get_uuid(), None))
+        thread.start()
+        thread.join()
+        self.assertTrue(readable())
+        self.node2.run_once(0)
+        self.assertFalse(readable())
+        self.node1.run_once(0)
+        self.assertTrue(readable())
+
+    def test_peer_set_timeout(self):
+        self.node2.run_once(0)
+        future = self.node2.peer_set(self.node1.get_uuid(), {"TestFloat": {"value": 2.0}}, timeout=0.05)
+        self.assertTrue(0 < self.node2.get_timeout() <= 51)
+        time.sleep(0.1)
+        self.node2.run_once(0)
+        self.assertIsInstance(future.exception(0), zocp.TimeoutError)
+
+    def test_peer_call(self):
+        self.node1.register_call("add", lambda a, b: a + b)
+        self.node1.register_call("slow_add", lambda a, b: a + b, threaded=True)
+        self.node2.run_once(0)
+        future = self.node2.peer_call(self.node1.get_uuid(), "add", 1, 2)
+        self.assertRaises(TypeError, self.node2.peer_call, self.node1.get_uuid(), "add", 1, b=2)
+        batch = self.node2.peer_call_many(self.node1.get_uuid(), [("slow_add", (2, 3)), ("missing", ())])
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        time.sleep(0.1)
+        self.node2.run_once(0)
+        self.assertEqual(3, future.result(0))
+        result = batch.result(0)
+        self.assertEqual(5, result[0])
+        self.assertIsInstance(result[1], zocp.ZOCPRequestError)
+
+    def test_callback_executor(self):
+        received = []
+        def on_peer_signaled(peer, name, data):
+            time.sleep(0.01)
+            received.append((data[1], threading.current_thread()))
+        executor = ThreadPoolExecutor(2)
+        self.node2.set_callback_executor(executor)
+        self.node2.on_peer_signaled = on_peer_signaled
+        self.node1.register_float("TestEmitFloat", 1.0, 'rwe')
+        self.node2.register_float("TestRecvFloat", 1.0, 'rws')
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        self.node2.signal_subscribe(self.node2.get_uuid(), "TestRecvFloat", self.node1.get_uuid(), "TestEmitFloat")
+        time.sleep(0.1)
+        self.node1.run_once(0)
+        for value in range(5):
+            self.node1.emit_signal("TestEmitFloat", float(value))
+        time.sleep(0.1)
+        self.node2.run_once(0)
+        # callbacks are queued per peer, wait for the chain to finish
+        time.sleep(0.2)
+        executor.shutdown(wait=True)
+        self.assertEqual([0.0, 1.0, 2.0, 3.0, 4.0], [value for value, thread in received])
+        self.assertNotIn(threading.current_thread(), [thread for value, thread in received])
+
+    def test_emit_nested_signal(self):
+        self.node1.set_object("Cube", "BPY_Mesh")
+        self.node1.register_vec3f("location", [0.0, 0.0, 0.0], 're')
+        self.node1.set_object()
+        self.node2.register_vec3f("TestRecvVec", [0.0, 0.0, 0.0], 'rws')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.node2.signal_subscribe(self.node2.get_uuid(), "TestRecvVec", self.node1.get_uuid(), "objects.Cube.location")
+        self.node1.run_once(0)
+        location = self.node1.capability["objects"]["Cube"]["location"]
+        self.assertIn((self.node2.get_uuid().hex, "TestRecvVec"), location["subscribers"])
+        self.node1.emit_signal("objects.Cube.location", [1.0, 2.0, 3.0])
+        self.node2.run_once(0)
+        self.assertEqual([1.0, 2.0, 3.0], self.node2.capability["TestRecvVec"]["value"])
+        mirror = self.node2.peers_capabilities[self.node1.get_uuid()]
+        self.assertEqual([1.0, 2.0, 3.0], mirror["objects"]["Cube"]["location"]["value"])
+
+    def test_signal_hop_limit(self):
+        self.node1.register_float("TestEmitFloat", 1.0, 'rwe')
+        self.node2.register_float("TestRecvFloat", 1.0, 'rwse')
+        self.node3 = zocp.ZOCP(transport=self.network.transport())
+        self.node3.register_float("TestRecvFloat", 1.0, 'rws')
+        self.node3.start()
+        try:
+            self.node2.signal_subscribe(self.node2.get_uuid(), "TestRecvFloat", self.node1.get_uuid(), "TestEmitFloat")
+            self.node3.signal_subscribe(self.node3.get_uuid(), "TestRecvFloat", self.node2.get_uuid(), "TestRecvFloat")
+            self.node1.run_once(0)
+            self.node2.run_once(0)
+            self.node2.max_signal_hops = 0
+            self.node1.emit_signal("TestEmitFloat", 2.0)
+            self.node2.run_once(0)
+            # the receiver is updated at the limit, the value isn't forwarded
+            self.assertEqual(2.0, self.node2.capability["TestRecvFloat"]["value"])
+            self.node3.run_once(0)
+            self.assertEqual(1.0, self.node3.capability["TestRecvFloat"]["value"])
+        finally:
+            self.node3.stop()
+
+    def test_pattern_subscribe(self):
+        received = []
+        self.node2.on_peer_signaled = lambda peer, name, data: received.append(data[0])
+        for name in ("Camera1", "Camera2", "Cube"):
+            self.node1.set_object(name, "BPY_Camera")
+            self.node1.register_vec3f("location", [0.0, 0.0, 0.0], 're')
+        self.node1.set_object()
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.node2.signal_subscribe(self.node2.get_uuid(), None, self.node1.get_uuid(), "objects.Camera*.location")
+        self.node1.run_once(0)
+        # parameters registered after subscribing match as well
+        self.node1.set_object("Camera3", "BPY_Camera")
+        self.node1.register_vec3f("location", [0.0, 0.0, 0.0], 're')
+        self.node1.set_object()
+        for name in ("Camera1", "Camera2", "Camera3", "Cube"):
+            self.node1.emit_signal("objects.%s.location" % name, [1.0, 1.0, 1.0])
+        self.node2.run_once(0)
+        self.assertEqual(["objects.Camera1.location", "objects.Camera2.location", "objects.Camera3.location"], received)
+
+    def test_bracket_subscribe(self):
+        received = []
+        self.node2.on_peer_signaled = lambda peer, name, data: received.append(data[0])
+        for name in ("a[0]", "a0", "a[1]"):
+            self.node1.register_float(name, 0.0, 're')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        # brackets are part of the name, not a character class
+        self.node2.signal_subscribe(self.node2.get_uuid(), None, self.node1.get_uuid(), "a[0]")
+        self.node2.signal_subscribe(self.node2.get_uuid(), None, self.node1.get_uuid(), "a[?]*")
+        self.node1.run_once(0)
+        for name in ("a[0]", "a0", "a[1]"):
+            self.node1.emit_signal(name, 1.0)
+        self.node2.run_once(0)
+        self.assertEqual(["a[0]", "a[1]"], received)
+
+    def test_pattern_resubscribe(self):
+        received = []
+        self.node2.on_peer_signaled = lambda peer, name, data: received.append(data[0])
+        self.node1.register_float("TestA", 0.0, 're')
+        self.node1.register_float("TestB", 0.0, 're')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        id1 = self.node1.get_uuid()
+        id2 = self.node2.get_uuid()
+        self.node2.signal_subscribe(id2, None, id1, "TestB")
+        self.node2.signal_subscribe(id2, None, id1, "Test*")
+        self.node1.run_once(0)
+        self.node2.signal_unsubscribe(id2, None, id1, "Test*")
+        self.node1.run_once(0)
+        self.assertEqual({}, self.node1._patterns)
+        # still subscribed explicitly
+        self.assertEqual([(id2.hex, None)], self.node1.capability["TestB"]["subscribers"])
+        self.assertEqual([], self.node1.capability["TestA"]["subscribers"])
+        self.node2.signal_subscribe(id2, None, id1, "Test*")
+        self.node1.run_once(0)
+        self.node1.emit_signal("TestA", 1.0)
+        self.node1.emit_signal("TestB", 1.0)
+        self.node2.run_once(0)
+        self.assertEqual(["TestA", "TestB"], received)
+
+    def test_parameter_record(self):
+        self.node1.register_int("TestInt", 1, 'rw', min=-10, max=10)
+        param = self.node1.capability["TestInt"]
+        self.assertIsInstance(param, zocp.Parameter)
+        self.assertEqual({'value': 1, 'typeHint': 'int', 'access': 'rw', 'subscribers': [], 'min': -10, 'max': 10}, dict(param))
+        self.assertNotIn('step', param)
+        param['unit'] = 'mm'
+        self.assertEqual('mm', param.get('unit'))
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.node2.peer_get_capability(self.node1.get_uuid())
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        mirror = self.node2.peers_capabilities[self.node1.get_uuid()]["TestInt"]
+        self.assertIsInstance(mirror, zocp.Parameter)
+        self.assertEqual(1, mirror["value"])
+        self.assertEqual("mm", mirror["unit"])
+        self.assertEqual(0, len(mirror["subscribers"]))
+
+    @unittest.skipIf(zocp.numpy is None, "requires numpy")
+    def test_value_store(self):
+        received = []
+        self.node2.on_peer_signaled = lambda peer, name, data: received.append(data[:2])
+        for i in range(3):
+            self.node1.register_vec3f("TestVec%d" % i, [0.0, 0.0, 0.0], 're')
+        self.node1.register_float("TestFloat", 1.0, 're')
+        store = self.node1.get_value_store()
+        for path in ("TestVec0", "TestVec1", "TestVec2", "TestFloat"):
+            store.add(path)
+        self.node1.run_once(0)
+        self.node2.signal_subscribe(self.node2.get_uuid(), None, self.node1.get_uuid(), None)
+        self.node1.run_once(0)
+        self.assertEqual(0, store.emit_changed())
+        store.column("vec3f")[1] = [1.0, 2.0, 3.0]
+        store.set("TestFloat", 2.0)
+        self.assertEqual(2, store.emit_changed())
+        self.assertEqual([1.0, 2.0, 3.0], self.node1.capability["TestVec1"]["value"])
+        self.node2.run_once(0)
+        self.assertEqual(sorted([["TestVec1", [1.0, 2.0, 3.0]], ["TestFloat", 2.0]]), sorted(received))
+        # NaN is reported changed once
+        store.set("TestFloat", float("nan"))
+        self.assertEqual(1, store.emit_changed())
+        self.assertEqual(0, store.emit_changed())
+
+    def test_set_unchanged(self):
+        modified = []
+        self.node1.on_modified = lambda peer, name, data: modified.append(data)
+        self.node1.register_vec3f("TestVec", (0.0, 0.0, 0.0), 'rw')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        for i in range(3):
+            self.node2.peer_set(self.node1.get_uuid(), {"TestVec": {"value": [1.0, 0.0, 0.0]}})
+        # setting the current value changes nothing
+        self.node2.peer_set(self.node1.get_uuid(), {"TestVec": {"value": [1.0, 0.0, 0.0], "access": "rw"}})
+        self.node1.run_once(0)
+        self.assertEqual(2, len(modified))
+        self.assertEqual({"TestVec": {"value": [1.0, 0.0, 0.0]}}, modified[1])
+
+    def test_snapshot(self):
+        self.node1.register_float("TestFloat", 1.0, 'rw')
+        self.node1.register_string("TestString", "abc", 'r')
+        self.node2.peer_get_capability(self.node1.get_uuid())
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        peer_cap = self.node2.snapshot().peers_capabilities[self.node1.get_uuid()]
+        self.assertEqual(1.0, peer_cap["TestFloat"]["value"])
+        self.assertRaises(TypeError, peer_cap.update, {"TestFloat": None})
+
+        snapshot = self.node1.snapshot()
+        self.node1.emit_signal("TestFloat", 2.0)
+        # nothing changes until the loop publishes a new snapshot
+        self.assertEqual(1.0, self.node1.snapshot().capability["TestFloat"]["value"])
+        self.node1.run_once(0)
+        new_snapshot = self.node1.snapshot()
+        self.assertEqual(2.0, new_snapshot.capability["TestFloat"]["value"])
+        self.assertEqual(1.0, snapshot.capability["TestFloat"]["value"])
+        # unmodified parts are shared
+        self.assertIs(snapshot.capability["TestString"], new_snapshot.capability["TestString"])
+
+    def test_snapshot_lazy(self):
+        self.node1.register_float("TestFloat", 1.0, 'rw')
+        for i in range(3):
+            self.node1.emit_signal("TestFloat", float(i))
+            self.node1.run_once(0)
+        # nothing was published before the first snapshot was asked for
+        snapshot = self.node1.snapshot()
+        self.assertEqual(1, snapshot.version)
+        self.assertEqual(2.0, snapshot.capability["TestFloat"]["value"])
+
+        snapshots = []
+        self.node2.register_float("TestFloat", 1.0, 'rw')
+        self.node2.run_once(0)
+        thread = threading.Thread(target=lambda: snapshots.append(self.node2.snapshot()))
+        thread.start()
+        while thread.is_alive():
+            self.node2.run_once(10)
+        self.assertEqual(1.0, snapshots[0].capability["TestFloat"]["value"])
+
+    def test_modified_in_place(self):
+        self.node1.set_object("Cube", "Mesh")
+        self.node1.register_float("size", 1.0, 'rwe')
+        self.node1.emit_signal("objects.Cube.size", 2.0)
+        # replace the objects like BpyZOCP.clear_objects does
+        self.node1.set_object()
+        self.node1.capability['objects'].clear()
+        self.node1.capability['objects']['Sphere'] = {'type': 'Mesh', 'radius': {'value': 1.0, 'typeHint': 'flt', 'access': 'rwe'}}
+        self.node1._on_modified(self.node1.capability)
+        self.assertRaises(KeyError, self.node1.emit_signal, "objects.Cube.size", 3.0)
+        self.node1.emit_signal("objects.Sphere.radius", 2.0)
+        self.assertEqual(2.0, self.node1.capability['objects']['Sphere']['radius']['value'])
+
+    def test_query(self):
+        self.node1.set_object("Cube", "Mesh")
+        self.node1.register_vec3f("location", (0.0, 0.0, 0.0), 'rw')
+        self.node1.register_float("size", 1.0, 'r')
+        self.node1.set_object("Light", "Lamp")
+        self.node1.register_vec3f("location", (0.0, 0.0, 0.0), 'r')
+        self.node1.set_object()
+        self.node2.peer_get_capability(self.node1.get_uuid())
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        peer = self.node1.get_uuid()
+        found = self.node2.query(name="location", typeHint="vec3f", access="w")
+        self.assertEqual([(peer, "objects.Cube.location")], [r[:2] for r in found])
+        self.assertEqual(2, len(self.node2.query(type="Mesh")))
+        self.assertEqual(2, len(self.node2.query(name="location")))
+        self.assertEqual([], self.node2.query(typeHint="percent"))
+
+    def test_query_peer_exit(self):
+        node = zocp.ZOCP(transport=self.network.transport())
+        try:
+            node.register_vec3f("location", (0.0, 0.0, 0.0), 'rw')
+            node.start()
+            self.node2.run_once(0)
+            node.run_once(0)
+            self.node2.run_once(0)
+            self.assertEqual(1, len(self.node2.query(name="location")))
+        finally:
+            node.stop()
+        # the exit drops the parameters of the peer from the index
+        self.node2.run_once(0)
+        self.assertEqual([], self.node2.query(name="location"))
+
+    def test_lazy_capabilities(self):
+        self.node1.register_float("TestFloat", 1.0, 'rw')
+        self.node2.lazy_capabilities = True
+        modified = []
+        self.node2.on_peer_modified = lambda peer, name, data: modified.append(data)
+        self.node2.whisper(self.node1.get_uuid(), json.dumps({'GET': None}).encode('utf-8'))
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        capability = self.node2.peers_capabilities[self.node1.get_uuid()]
+        self.assertIsInstance(capability, zocp.LazyCapability)
+        self.assertFalse(capability.is_loaded())
+        self.assertEqual(1.0, capability["TestFloat"]["value"])
+        self.assertTrue(capability.is_loaded())
+        self.assertEqual(1.0, modified[0]["TestFloat"]["value"])
+        self.assertEqual(1, len(self.node2.query(name="TestFloat")))
+        self.assertEqual(1, self.node2.get_method_stats()['MOD']['count'])
+
+    def test_lazy_capabilities_partial(self):
+        self.node2.lazy_capabilities = True
+        modified = []
+        self.node2.on_peer_modified = lambda peer, name, data: modified.append(data)
+        peer = self.node1.get_uuid()
+        self.node1.whisper(self.node2.get_uuid(), b'{ "MOD" : {"a": {"x": 1}, "b": {"y": 2}}}')
+        self.node2.run_once(0)
+        capability = self.node2.peers_capabilities[peer]
+        self.assertFalse(capability.is_loaded())
+        self.assertEqual({"x": 1}, capability["a"])
+        # only the accessed key is merged
+        self.assertEqual([{"a": {"x": 1}}], modified)
+        self.assertFalse(capability.is_loaded())
+        self.assertEqual(["a", "b"], sorted(capability))
+        self.assertTrue(capability.is_loaded())
+        # a MOD changing nothing fires no callback
+        self.node1.whisper(self.node2.get_uuid(), b'{"MOD": {"a": {"x": 1}}}')
+        self.node2.run_once(0)
+        self.assertEqual({"x": 1}, capability["a"])
+        self.assertEqual(2, len(modified))
+
+    def test_peer_version(self):
+        peer = self.node1.get_uuid()
+        future = self.node2.peer_get_version(peer)
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        version = future.result(0)
+        self.node1.register_float("TestFloat", 1.0, 'rw')
+        future = self.node2.peer_get_version(peer)
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.assertNotEqual(version, future.result(0))
+        version = future.result(0)
+        # changes of values only keep the version
+        self.node1.emit_signal("TestFloat", 2.0)
+        self.node1._handle_SET({"TestFloat": {"value": 3.0}}, self.node2.get_uuid(), "node2", None)
+        self.assertEqual(version, self.node1._cap_version)
+        # the version is sent along with the capability
+        self.node2._peer_versions.clear()
+        self.node2.peer_get_capability(peer)
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.node2.run_once(0)
+        self.assertEqual(version, self.node2._peer_versions[peer])
+
+    def test_peer_cache(self):
+        cache = zocp.PeerCache(max_peers=2, max_bytes=100)
+        cache.put("a", {}, 10)
+        cache.put("b", {}, 10)
+        cache.put("c", {}, 10)
+        self.assertNotIn("a", cache)
+        self.assertEqual(2, len(cache))
+        cache.put("d", {}, 85)
+        self.assertEqual(["c", "d"], [p for p in "abcd" if p in cache])
+        self.assertEqual(95, cache.size)
+        self.assertEqual({}, cache.pop("d"))
+        self.assertEqual(10, cache.size)
+
+    def test_subscribe_batch(self):
+        self.node1.register_float("TestFloat", 1.0, 'rw')
+        self.node1.register_int("TestInt", 1, 'rw')
+        emit_peer = self.node1.get_uuid().hex
+        recv_peer = self.node2.get_uuid().hex
+        subs = [[emit_peer, "TestFloat", recv_peer, None],
+                [emit_peer, "TestInt", recv_peer, None]]
+        self.node2.whisper(self.node1.get_uuid(), json.dumps({'SUBS': subs}).encode('utf-8'))
+        self.node1.run_once(0)
+        subscribers = self.node1.subscribers[self.node2.get_uuid()]
+        self.assertEqual({"TestFloat": [None], "TestInt": [None]}, subscribers)
+
+    def test_peer_protocol(self):
+        self.node1.register_float("TestFloat", 1.0, 'rw')
+        self.node1.register_int("TestInt", 1, 'rw')
+        emit_peer = self.node1.get_uuid()
+        recv_peer = self.node2.get_uuid()
+        self.assertEqual(zocp.ZOCP_PROTOCOL, self.node2._peer_protocol(emit_peer))
+        # peers of older versions get single subscriptions
+        self.node1.set_header("X-ZOCP-PROTO", "1")
+        self.node2.signal_subscribe_many([(recv_peer, None, emit_peer, "TestFloat"),
+                                          (recv_peer, None, emit_peer, "TestInt")])
+        for i in range(3):
+            self.node1.run_once(0)
+        methods = self.node1.get_metrics()['methods']
+        self.assertNotIn('SUBS', methods)
+        self.assertEqual(2, methods['SUB']['messages_in'])
+        self.assertEqual(set(["TestFloat", "TestInt"]), set(self.node1.subscribers[recv_peer]))
+
+    def test_subscribe_many(self):
+        names = ["TestFloat%d" % i for i in range(5)]
+        for name in names:
+            self.node1.register_float(name, 1.0, 'rw')
+        self.node1.register_float("Watched", 1.0, 'rw')
+        modified = []
+        self.node1.on_modified = lambda peer, name, data: modified.append(data)
+        emit_peer = self.node1.get_uuid()
+        recv_peer = self.node2.get_uuid()
+        self.node2.signal_subscribe_many([(recv_peer, None, emit_peer, name) for name in names])
+        self.node1.run_once(0)
+        self.assertEqual(set(names), set(self.node1.subscribers[recv_peer]))
+        # the subscribers of all emitters are modified at once
+        self.assertEqual(1, len(modified))
+        self.assertEqual(set(names), set(modified[0]))
+        self.node2.signal_unsubscribe_many([(recv_peer, None, emit_peer, name) for name in names[1:]])
+        self.node1.run_once(0)
+        self.assertEqual([names[0]], list(self.node1.subscribers[recv_peer]))
+        self.assertEqual([names[0]], list(self.node2.subscriptions[emit_peer]))
+
+    def test_unsubscribe_keeps_other_receivers(self):
+        self.node1.register_float("TestEmitFloat", 1.0, 'rw')
+        self.node2.register_float("TestRecvFloat", 1.0, 'rw')
+        emit_peer = self.node1.get_uuid()
+        recv_peer = self.node2.get_uuid()
+        self.node2.signal_subscribe(recv_peer, None, emit_peer, "TestEmitFloat")
+        self.node2.signal_subscribe(recv_peer, "TestRecvFloat", emit_peer, "TestEmitFloat")
+        self.node1.run_once(0)
+        self.node2.signal_unsubscribe(recv_peer, "TestRecvFloat", emit_peer, "TestEmitFloat")
+        self.node1.run_once(0)
+        # the subscription without receiver remains
+        self.assertEqual([None], self.node2.subscriptions[emit_peer]["TestEmitFloat"])
+        self.assertEqual([None], self.node1.subscribers[recv_peer]["TestEmitFloat"])
+        self.assertEqual([[recv_peer.hex, None]],
+                json.loads(zocp.encode_message(self.node1.capability["TestEmitFloat"]))["subscribers"])
+
+    def test_routing_graph(self):
+        self.node1.register_float("TestEmitFloat", 1.0, 'rw')
+        self.node2.register_float("TestRecvFloat", 1.0, 'rw')
+        emit_peer = self.node1.get_uuid()
+        recv_peer = self.node2.get_uuid()
+        self.node2.signal_subscribe(recv_peer, "TestRecvFloat", emit_peer, "TestEmitFloat")
+        self.node1.signal_subscribe(emit_peer, "TestEmitFloat", recv_peer, "TestRecvFloat")
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.node1.peer_get_capability(recv_peer)
+        self.node2.run_once(0)
+        self.node1.run_once(0)
+        graph = self.node1.get_routing_graph()
+        source = (emit_peer.hex, "TestEmitFloat")
+        self.assertEqual({source: 0, (recv_peer.hex, "TestRecvFloat"): 1}, graph.hops(source))
+        self.assertEqual(1, len(graph.find_cycles()))
+        self.assertEqual(2, len(graph.find_cycles()[0]))
+
+        # a signal is forwarded back once, then the values are equal
+        self.node1.emit_signal("TestEmitFloat", 2.0)
+        self.node2.run_once(0)
+        self.node1.run_once(0)
+        self.assertEqual(2.0, self.node2.capability["TestRecvFloat"]["value"])
+        self.assertEqual({}, self.node2.get_route_stats())
+        self.assertEqual([1], list(self.node1.get_route_stats()))
+
+    def test_local_subscribe(self):
+        self.node1.register_float("TestEmitFloat", 1.0, 'rw')
+        self.node1.register_float("TestRecvFloat", 1.0, 'rw')
+        signaled = []
+        self.node1.on_peer_signaled = lambda peer, name, data: signaled.append((peer, data))
+        node_id = self.node1.get_uuid()
+        self.node1.signal_subscribe(node_id, "TestRecvFloat", node_id, "TestEmitFloat")
+        self.assertIn("TestEmitFloat", self.node1.subscribers[node_id])
+        self.node1.emit_signal("TestEmitFloat", 2.0)
+        self.node1.run_once(0)
+        self.assertEqual(2.0, self.node1.capability["TestRecvFloat"]["value"])
+        self.assertEqual([(node_id, ["TestEmitFloat", 2.0, ["TestRecvFloat"]])], signaled)
+
+    def test_set_signals(self):
+        received = []
+        self.node2.on_peer_signaled = lambda peer, name, data: received.append(data)
+        self.node1.register_float("TestEmitFloat", 1.0, 'rwe')
+        self.node2.signal_subscribe(self.node2.get_uuid(), None, self.node1.get_uuid(), "TestEmitFloat")
+        self.node1.run_once(0)
+        # a SET of a single value is signaled like an emit
+        self.node1._handle_SET({"TestEmitFloat": {"value": 3.0}}, uuid.uuid4(), "node3", None)
+        self.node2.run_once(0)
+        self.assertEqual([["TestEmitFloat", 3.0, [None]]], received)
+        self.assertEqual(1, self.node1.get_metrics()["emitters"]["TestEmitFloat"])
+
+    def test_relay(self):
+        relay = zocp.ZOCPRelay(transport=self.network.transport())
+        relay.set_name("relay")
+        relay.start()
+        try:
+            self.node1.register_float("TestEmitFloat", 1.0, 'rwe')
+            source = self.node1.get_uuid()
+            for node in (self.node1, self.node2, relay):
+                node.run_once(0)
+            relay.relay(source, "TestEmitFloat")
+            path = relay.get_relay_path(source, "TestEmitFloat")
+            self.node2.signal_subscribe(self.node2.get_uuid(), None, relay.get_uuid(), path)
+            signaled = []
+            self.node2.on_peer_signaled = lambda peer, name, data: signaled.append(data[1])
+            relay.set_qos(self.node2.get_uuid(), max_rate=5)
+            self.node1.run_once(0)
+            relay.run_once(0)
+            for value in (2.0, 3.0, 4.0):
+                self.node1.emit_signal("TestEmitFloat", value)
+                relay.run_once(0)
+            # the first signal is sent, the others are held back
+            self.assertEqual(4.0, relay.capability["relay"][source.hex]["TestEmitFloat"]["value"])
+            self.assertEqual('re', relay.capability["relay"][source.hex]["TestEmitFloat"]["access"])
+            self.assertEqual([relay.get_uuid()], list(self.node1.subscribers))
+            self.node2.run_once(0)
+            self.assertEqual([2.0], signaled)
+            time.sleep(0.25)
+            relay.run_once(0)
+            self.node2.run_once(0)
+            self.assertEqual([2.0, 4.0], signaled)
+        finally:
+            relay.stop()
+
+    def test_relay_clock(self):
+        # a clock starting at 0, like time.monotonic on some systems
+        now = [0.0]
+        clock, zocp._clock = zocp._clock, lambda: now[0]
+        relay = zocp.ZOCPRelay(transport=self.network.transport())
+        relay.start()
+        try:
+            self.node1.register_float("TestEmitFloat", 1.0, 'rwe')
+            source = self.node1.get_uuid()
+            for node in (self.node1, self.node2, relay):
+                node.run_once(0)
+            relay.relay(source, "TestEmitFloat")
+            path = relay.get_relay_path(source, "TestEmitFloat")
+            self.node2.signal_subscribe(self.node2.get_uuid(), None, relay.get_uuid(), path)
+            signaled = []
+            self.node2.on_peer_signaled = lambda peer, name, data: signaled.append(data[1])
+            relay.set_qos(self.node2.get_uuid(), max_rate=5)
+            self.node1.run_once(0)
+            relay.run_once(0)
+            for value in (2.0, 3.0):
+                self.node1.emit_signal("TestEmitFloat", value)
+                relay.run_once(0)
+            self.node2.run_once(0)
+            self.assertEqual([2.0], signaled)
+            now[0] = 0.2
+            relay.run_once(0)
+            self.node2.run_once(0)
+            self.assertEqual([2.0, 3.0], signaled)
+        finally:
+            zocp._clock = clock
+            relay.stop()
+
+    def test_zones(self):
+        nodes = []
+        try:
+            for zones in (["stage"], ["stage", "foyer"], ["foyer"]):
+                node = zocp.ZOCP(transport=self.network.transport())
+                node.set_zones(zones)
+                node.register_float("TestFloat", 1.0, 'r')
+                node.start()
+                nodes.append(node)
+            for i in range(3):
+                for node in nodes:
+                    node.run_once(0)
+            [stage, both, foyer] = nodes
+            self.assertIn("TestFloat", stage.peers_capabilities[both.get_uuid()])
+            self.assertIn("TestFloat", foyer.peers_capabilities[both.get_uuid()])
+            self.assertIn("TestFloat", both.peers_capabilities[foyer.get_uuid()])
+            # no shared zone, so no capability sync
+            self.assertEqual({}, stage.peers_capabilities[foyer.get_uuid()])
+            self.assertEqual({}, stage.peers_capabilities[self.node1.get_uuid()])
+            stage.set_zones(["stage", "foyer"])
+            foyer.run_once(0)
+            stage.run_once(0)
+            self.assertIn("TestFloat", stage.peers_capabilities[foyer.get_uuid()])
+        finally:
+            for node in nodes:
+                node.stop()
+
+    def test_static_peers(self):
+        ctx = zmq.Context()
+        first = zocp.StaticTransport("tcp://127.0.0.1:*", ctx=ctx)
+        nodes = [zocp.ZOCP(transport=first)]
+        try:
+            nodes[0].register_float("TestFloat", 1.0, 'r')
+            nodes[0].start()
+            # the third node only knows the second and finds the first
+            # through it
+            for node in range(2):
+                seed = nodes[-1]._transport.address
+                nodes.append(zocp.ZOCP(endpoint="tcp://127.0.0.1:*", peers=[seed], ctx=ctx))
+                nodes[-1].start()
+            deadline = time.time() + 2
+            while time.time() < deadline and any(
+                    "TestFloat" not in node.peers_capabilities.get(nodes[0].get_uuid(), {})
+                    for node in nodes[1:]):
+                for node in nodes:
+                    node.run_once(10)
+            for node in nodes[1:]:
+                self.assertEqual(1.0, node.peers_capabilities[nodes[0].get_uuid()]["TestFloat"]["value"])
+            self.assertEqual(first.address, nodes[2].get_peer_address(nodes[0].get_uuid()))
+            nodes.pop().stop()
+            time.sleep(0.1)
+            for node in nodes:
+                node.run_once(10)
+            self.assertEqual(1, len(nodes[0].get_peers()))
+        finally:
+            for node in nodes:
+                node.stop()
+
+    def test_memory_network(self):
+        # signals between nodes on the network don't bypass it
+        self.assertFalse(self.node1.local_delivery)
+        self.assertNotIn(self.node1.get_uuid(), zocp._local_nodes)
+        self.assertTrue(self.node1._transport.address.startswith("mem://"))
+        def whispers(transport):
+            received = []
+            while transport.inbox.poll(0):
+                msg = transport.recv()
+                if msg[0] == b"WHISPER":
+                    received.append(int(msg[3]))
+            return received
+        def run(seed):
+            network = zocp.MemoryNetwork(latency=0.01, jitter=0.02, loss=0.2, seed=seed, realtime=False)
+            sender = network.transport()
+            receiver = network.transport()
+            sender.start()
+            receiver.start()
+            try:
+                for i in range(50):
+                    sender.whisper(receiver.get_uuid(), str(i).encode('utf-8'))
+                self.assertEqual([], whispers(receiver))
+                network.advance(0.1)
+                return whispers(receiver), network.dropped
+            finally:
+                sender.stop()
+                receiver.stop()
+                network.close()
+        received, dropped = run(1)
+        self.assertEqual(50, len(received) + dropped)
+        self.assertTrue(dropped > 0)
+        self.assertNotEqual(sorted(received), received)
+        # the same seed gives the same losses and order
+        self.assertEqual((received, dropped), run(1))
+
+    def test_pyre_transport(self):
+        ctx = zmq.Context()
+        node1 = zocp.ZOCP(ctx=ctx)
+        node2 = zocp.ZOCP(ctx=ctx)
+        try:
+            node1.register_float("TestFloat", 1.0, 'r')
+            node1.start()
+            node2.start()
+            time.sleep(1)
+            for node in (node2, node1, node2):
+                node.run_once(0)
+                time.sleep(0.1)
+            self.assertIn(node1.get_uuid(), node2.get_peers())
+            self.assertIn("TestFloat", node2.peers_capabilities[node1.get_uuid()])
+        finally:
+            node1.stop()
+            node2.stop()
+
+    def test_metrics(self):
+        received = []
+        self.node2.on_peer_signaled = lambda peer, name, data: received.append(data)
+        self.node1.register_float("TestEmitFloat", 1.0, 'rwe')
+        self.node2.register_float("TestRecvFloat", 1.0, 'rws')
+        self.node1.run_once(0)
+        self.node2.run_once(0)
+        self.node1.local_delivery = False
+        self.node2.signal_subscribe(self.node2.get_uuid(), "TestRecvFloat", self.node1.get_uuid(), "TestEmitFloat")
+        self.node1.run_once(0)
+        self.node1.emit_signal("TestEmitFloat", 2.0)
+        self.node2.run_once(0)
+        id1 = self.node1.get_uuid()
+        id2 = self.node2.get_uuid()
+        metrics1 = self.node1.get_metrics()
+        metrics2 = self.node2.get_metrics()
+        self.assertEqual(1, metrics1["methods"]["SIG"]["messages_out"])
+        self.assertEqual(1, metrics2["methods"]["SIG"]["messages_in"])
+        self.assertEqual(metrics1["methods"]["SIG"]["bytes_out"], metrics2["methods"]["SIG"]["bytes_in"])
+        self.assertEqual(1, metrics1["emitters"]["TestEmitFloat"])
+        self.assertEqual(1, metrics2["peer_emitters"][id1]["TestEmitFloat"])
+        self.assertEqual(metrics1["peers"][id2]["messages_out"], metrics2["peers"][id1]["messages_in"])
+        self.assertEqual(metrics2["totals"]["messages_in"], metrics2["dispatch"]["count"])
+        self.assertTrue(metrics2["callbacks"]["count"] >= len(received) > 0)
+        # a summary is published as a read-only part of the capability
+        version = self.node1._cap_version
+        self.node1.set_stats_interval(0.01)
+        time.sleep(0.02)
+        self.node1.run_once(0)
+        # publishing doesn't change the version of the capability
+        self.assertEqual(version, self.node1._cap_version)
+        stats = self.node1.capability["_stats"]
+        self.assertEqual(metrics1["totals"]["messages_out"], stats["messages_out"])
+        self.node2.peer_set(id1, {"_stats": {"messages_out": 0}})
+        self.node1.run_once(0)
+        self.assertEqual(metrics1["totals"]["messages_out"], self.node1.capability["_stats"]["messages_out"])
+        self.node1.set_stats_interval(None)
+        self.assertNotIn("_stats", self.node1.capability)
+
+    def test_metrics_peer_exit(self):
+        node = zocp.ZOCP(transport=self.network.transport())
+        try:
+            node.start()
+            self.node2.run_once(0)
+            node.run_once(0)
+            self.node2.run_once(0)
+            self.assertIn(node.get_uuid(), self.node2.get_metrics()["peers"])
+            totals = self.node2.get_metrics()["totals"]
+        finally:
+            node.stop()
+        # the counters of the exited peer only remain in the totals
+        self.node2.run_once(0)
+        metrics = self.node2.get_metrics()
+        self.assertNotIn(node.get_uuid(), metrics["peers"])
+        self.assertEqual(totals, metrics["totals"])
 # end ZOCPTest
 
 if __name__ == '__main__':